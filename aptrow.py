@@ -17,11 +17,22 @@
 
 import urllib
 import os
+import sys
 import traceback
 import cgi
 import io
+import threading
+import time
+import weakref
+import collections
+import uuid
+import hashlib
+import email.utils
+import asyncio
+import concurrent.futures
 
 import htmltags as tag
+from lrucache import LruCache
 
 def h(value):
     """ HTML escape a string value """
@@ -41,17 +52,33 @@ def spacedList(theList):
 """A mapping from URL prefix to ResourceModule"""
 resourceModules = {}
 
+"""Lock guarding changes to the shared registries (resourceModules, the resource classes of each
+ResourceModule, and the interpretation methods of each ResourceInterface), so that modules can
+be registered while a multi-threaded server is handling requests."""
+registryLock = threading.RLock()
+
 def addResourceModule(prefix, resourceModule):
     """Add a ResourceModule to resourceModules, also record the ResourceModule's urlPrefix value
     (so we can go from URL to Resource and back again)"""
-    resourceModule.urlPrefix = prefix
-    resourceModules[prefix] = resourceModule
+    with registryLock:
+        resourceModule.urlPrefix = prefix
+        resourceModules[prefix] = resourceModule
+        for name, resourceClass in resourceModule.classes.items():
+            setResourceUrlPrefix(resourceClass)
+    
+def registeredResourceModules():
+    """Return a snapshot list of (prefix, ResourceModule) pairs (safe to iterate over
+    while other threads register modules)"""
+    with registryLock:
+        return list(resourceModules.items())
     
 def addModule(prefix, moduleName, moduleAttribute = "aptrowModule"):
     """Import the named module and add it's enclosed ResourceModule 
-    (by default defined as <module>.aptrowModule)"""
-    module =__import__(moduleName, locals(), globals(), [], -1)
-    addResourceModule(prefix, getattr(module, moduleAttribute))
+    (by default defined as <module>.aptrowModule). Call this before runAptrowServer, so
+    that in "prefork" mode the module is imported once in the parent process."""
+    with registryLock:
+        module =__import__(moduleName, globals(), locals(), [], 0)
+        addResourceModule(prefix, getattr(module, moduleAttribute))
 
 class ResourceModule:
     """A ResourceModule represents information about Resource classes defined within one
@@ -71,6 +98,11 @@ class ResourceModule:
         if resourceClass == None:
             raise ResourceTypeNotFoundForPathException("%s%s" % (self.urlPrefix, name))
         return resourceClass
+    
+    def resourceClasses(self):
+        """Return a snapshot list of (name, Resource class) pairs"""
+        with registryLock:
+            return list(self.classes.items())
         
 aptrowModule = ResourceModule()
 
@@ -79,12 +111,19 @@ def resourceTypeNameInModule(name, module):
     for a resource class, i.e. a class derived from Resource, relative to a ResourceModule """
     def registerResourceClass(resourceClass):
         print("Registering resource class %s" % (resourceClass.__name__))
-        module.classes[name] = resourceClass
-        resourceClass.resourcePath = name
-        resourceClass.module = module
+        with registryLock:
+            module.classes[name] = resourceClass
+            resourceClass.resourcePath = name
+            resourceClass.module = module
+            if hasattr(module, "urlPrefix"):
+                setResourceUrlPrefix(resourceClass)
         return resourceClass
     return registerResourceClass
 
+def setResourceUrlPrefix(resourceClass):
+    """Precompute the URL path of a resource class (once its module's prefix is known)"""
+    resourceClass.resourceUrlPrefix = "/%s/%s" % (resourceClass.module.urlPrefix, resourceClass.resourcePath)
+
 class MessageException(Exception):
     """An exception class whose default string representation is the 'message' attribute."""
     def __str__(self):
@@ -96,6 +135,10 @@ class ResourceTypeNotFoundForPathException(MessageException):
         self.path = path
         self.message = "No resource type defined for path \"%s\"" % path
 
+"""Cache of resources found by getResource, keyed by canonical URL. Resources in the cache 
+are shared between requests (and threads), so a resource must not be modified once created."""
+resourceCache = LruCache(10000)
+
 def getResource(url):
     """Given a URL, find or create the corresponding resource that the URL represents.
     (The intention is to support remote resources from other Aptrow servers, but currently
@@ -103,7 +146,10 @@ def getResource(url):
     
     Even though WSGI functions parse URL's and query parameters for you, this method (which
     duplicates some of that parsing) is needed
-    to process URL's included as parameter values in other URL's. """
+    to process URL's included as parameter values in other URL's. 
+    
+    Resources are cached in resourceCache, so a resource nested inside other resources (as a
+    ResourceParam value) is only created once, and not again for each request or link."""
     
     if url.startswith("/"):
         localUrl = url[1:]
@@ -114,8 +160,12 @@ def getResource(url):
         else:
             path = localUrl[:queryStart]
             query = localUrl[queryStart+1:]
-        resource, view = getResourceAndViewFromPathAndQuery(path, query)
-        return resource
+        aptrowQueryParams = AptrowQueryParams.fromQuery(query)
+        def createResource():
+            resource, view = getResourceAndViewFromPathAndQueryParams(path, aptrowQueryParams)
+            return resource
+        canonicalUrl = "/%s?%s" % (path, aptrowQueryParams.canonicalResourceQuery())
+        return resourceCache.getOrCreate(canonicalUrl, createResource)
     else:
         raise Error("Non-local resource URL's not yet implemented (doesn't start with '/'): %s" % localUrl)
     
@@ -133,6 +183,10 @@ def getResourceAndViewFromPathAndQuery(path, query):
     "contents" attribute of a File resource, with additional optional parameter "contentType".) 
     A numbering scheme allows attribute lookups to be chained (see AptrowQueryParams for details). 
     """
+    return getResourceAndViewFromPathAndQueryParams(path, AptrowQueryParams.fromQuery(query))
+
+def getResourceAndViewFromPathAndQueryParams(path, aptrowQueryParams):
+    """Look up resource object from URL path and already parsed AptrowQueryParams."""
     secondSlashPos = path.find("/")
     if secondSlashPos != -1:
         urlPrefix = path[:secondSlashPos]
@@ -145,11 +199,8 @@ def getResourceAndViewFromPathAndQuery(path, query):
         resourceClass = resourceModule.getResourceClass(path[secondSlashPos+1:])
     if resourceClass == None:
         raise ResourceTypeNotFoundForPathException(path)
-    queryParams = urllib.parse.parse_qs(query)
-    aptrowQueryParams = AptrowQueryParams(queryParams)
     resourceParamValues = getResourceParams(aptrowQueryParams, resourceClass.resourceParams)
     object = resourceClass(*resourceParamValues)
-    object.resourceParamValues = resourceParamValues # record parameters passed in
     for attribute,params in aptrowQueryParams.attributesAndParams():
         attributeValue = object.resolveAttribute(attribute, params)
         if attributeValue == None:
@@ -167,28 +218,111 @@ class AptrowApp:
     def __init__(self, environ, start_response):
         """WSGI initialiser: save environment and response object"""
         self.environ = environ
-        self.start = start_response
+        self.start_response = start_response
+        self.resourceAndView = None
+        self.validator = None
+        self.validatorHeaders = []
+        self.conditionsChecked = False
+        self.responseStatus = None
+        self.responseHeaders = None
         #print ("environ = %r" % environ)
         
-    def not_found(self, message):
-        """General handler for something not found: currently a message in a plain-text page."""
-        self.start('404 Not Found', [('Content-type', 'text/plain')])
-        return message
-    
-    def __iter__(self):
-        """Main WSGI method to yield content of requested web page. Looks up resource from URL, 
-        and then calls resouce "page" method to render the web page."""
+    def start(self, status, response_headers):
+        """Start the response (adding any validator headers to a successful response)"""
+        self.responseStatus = status
+        self.responseHeaders = response_headers
+        if status.startswith("2"):
+            response_headers = response_headers + self.validatorHeaders
+        self.start_response(status, response_headers)
+        
+    def checkConditions(self, object, view):
+        """Work out validator headers for the resource (if it has a validator, see Resource.validator), 
+        and if the request's If-None-Match or If-Modified-Since header shows that the client already 
+        has the current version, send a 304 response and return True."""
+        self.conditionsChecked = True
+        try:
+            validator = object.validator(view)
+        except Exception: # (treated as no validator, leaving the page to report whatever is wrong)
+            validator = None
+        self.validator = validator
+        if validator == None:
+            return False
+        etag = validator.etag(object.url(view = view))
+        self.validatorHeaders = [('ETag', etag)]
+        if validator.lastModified != None:
+            self.validatorHeaders.append(('Last-Modified', email.utils.formatdate(validator.lastModified, usegmt = True)))
+        ifRange = self.environ.get('HTTP_IF_RANGE')
+        if ifRange != None and ifRange != etag:
+            self.environ.pop('HTTP_RANGE', None) # send the whole (changed) resource
+        ifNoneMatch = self.environ.get('HTTP_IF_NONE_MATCH')
+        ifModifiedSince = self.environ.get('HTTP_IF_MODIFIED_SINCE')
+        if ifNoneMatch != None:
+            matchingTags = [tag.strip() for tag in ifNoneMatch.split(",")]
+            notModified = "*" in matchingTags or etag in matchingTags or ("W/%s" % etag) in matchingTags
+        elif ifModifiedSince != None and validator.lastModified != None:
+            try:
+                since = email.utils.parsedate_to_datetime(ifModifiedSince).timestamp()
+            except (TypeError, ValueError):
+                return False
+            notModified = int(validator.lastModified) <= since
+        else:
+            notModified = False
+        if notModified:
+            self.start_response('304 Not Modified', self.validatorHeaders)
+        return notModified
+        
+    def pathInfo(self):
         pathInfo = self.environ['PATH_INFO']
         # print ("pathInfo = %r" % pathInfo)
         if pathInfo.startswith("/"):
             pathInfo = pathInfo[1:]
+        return pathInfo
+        
+    def getResourceAndView(self):
+        """Look up the requested resource (and view), and check that it exists"""
         queryString = self.environ['QUERY_STRING']
         print ("queryString = %r" % queryString)
+        object, view = getResourceAndViewFromPathAndQuery(self.pathInfo(), queryString)
+        object.checkExists()
+        return object, view
+    
+    def result(self):
+        """Return the WSGI result: normally this object (see __iter__), but for a resource which can be 
+        sent as a file on the local file system, the file wrapped in the server's 'wsgi.file_wrapper' 
+        (which lets the server send it with sendfile)."""
+        try:
+            self.resourceAndView = self.getResourceAndView()
+        except MessageException:
+            return self # __iter__ will report the error
+        object, view = self.resourceAndView
+        if self.checkConditions(object, view):
+            return []
+        fileResult = object.fileResult(self, view)
+        return self if fileResult == None else fileResult
+        
+    def not_found(self, message):
+        """General handler for something not found: currently a message in a plain-text page."""
+        self.start('404 Not Found', [('Content-type', 'text/plain; charset=utf-8')])
+        return message
+    
+    def __iter__(self):
+        """Main WSGI method to yield content of requested web page (see pageParts), with text encoded
+        as UTF-8 (as WSGI servers only accept bytes)."""
+        for part in self.pageParts():
+            yield part.encode("utf-8") if isinstance(part, str) else part
+            
+    def pageParts(self):
+        """Yield content of requested web page. Looks up resource from URL, 
+        and then calls resouce "page" method to render the web page."""
+        pathInfo = self.pathInfo()
         try:
-            object, view = getResourceAndViewFromPathAndQuery(pathInfo, queryString)
-            object.checkExists()
+            if self.resourceAndView == None:
+                self.resourceAndView = self.getResourceAndView()
+            object, view = self.resourceAndView
+            if not self.conditionsChecked and self.checkConditions(object, view):
+                return
             self.message = ""
-            for text in object.page(self, view): yield text
+            for text in self.cachedPage(object, view): yield text
         except MissingParameterException as exc:
             yield self.not_found("For resource type \"%s\" %s" % (pathInfo, exc.message))
         except UnknownAttributeException as exc:
@@ -198,11 +332,161 @@ class AptrowApp:
         except (NoSuchObjectException, ParameterException) as exception:
             yield self.not_found(exception.message)
 
-def runAptrowServer(host, port):
-    from wsgiref.simple_server import make_server
+    def cachedPage(self, object, view):
+        """The resource's page: from pageCache if it has a current copy, otherwise rendered by the 
+        resource's 'page' method while recording the sources it depends on (see recordPageSource), 
+        and then cached if every one of those sources has a validator."""
+        if self.environ.get('HTTP_RANGE') != None:
+            for text in object.page(self, view): yield text
+            return
+        key = object.url(view = view)
+        cachedPage = pageCache.get(key)
+        if cachedPage != None:
+            self.start(cachedPage.status, cachedPage.headers)
+            yield cachedPage.body
+            return
+        recording = PageRecording()
+        if self.validator != None:
+            recording.sources.append((object, view, self.validator.token))
+        elif not object.recordsPageSources(view):
+            recording.cacheable = False
+        parts = []
+        size = 0
+        pageIterator = object.page(self, view)
+        while True:
+            previousRecording = getattr(pageRecordings, "current", None)
+            pageRecordings.current = recording
+            try:
+                text = next(pageIterator)
+            except StopIteration:
+                break
+            finally:
+                pageRecordings.current = previousRecording
+            if recording.cacheable:
+                parts.append(text)
+                size += len(text)
+                if size > pageCache.maxPageBytes():
+                    recording.cacheable = False
+                    parts = []
+            yield text
+        if recording.cacheable and self.responseStatus != None and self.responseStatus.startswith("200"):
+            pageCache.put(key, CachedPage(self.responseStatus, self.responseHeaders, parts, recording))
 
-    httpd = make_server(host, port, AptrowApp)
-    print("Serving HTTP on http://%s:%s/ ..." % (host, port))
+def wsgiApplication(environ, start_response):
+    """The Aptrow WSGI application as a function (which, unlike AptrowApp itself, can return 
+    the server's 'wsgi.file_wrapper' for file contents)"""
+    return AptrowApp(environ, start_response).result()
+
+class AptrowAsgiApp:
+    """ASGI (asyncio) entry point to the Aptrow application. Each request is handled by an AptrowApp, 
+    but all the blocking work (looking up the resource, and producing each part of its page) is run in 
+    a thread pool executor, so that the event loop is only ever waiting on sockets. A connection only
+    occupies an executor thread while its page is actually being produced, so any number of idle or slow
+    clients can be connected at once.
+    Output is sent back as it is produced: the executor returns whatever the page has yielded once it 
+    amounts to 'chunkSize' bytes or has taken 'chunkSeconds' seconds to produce."""
+    
+    chunkSize = 16384
+    chunkSeconds = 0.1
+    
+    def __init__(self, executorThreads = 16):
+        self.executor = concurrent.futures.ThreadPoolExecutor(executorThreads)
+        
+    def wsgiEnviron(self, scope):
+        """Construct the WSGI environment that AptrowApp expects from an ASGI HTTP scope"""
+        server = scope.get("server") or ("localhost", 80)
+        environ = {"REQUEST_METHOD": scope["method"], 
+                   "SCRIPT_NAME": scope.get("root_path", ""), 
+                   "PATH_INFO": scope["path"], 
+                   "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"), 
+                   "SERVER_NAME": server[0], 
+                   "SERVER_PORT": str(server[1]), 
+                   "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"), 
+                   "wsgi.url_scheme": scope.get("scheme", "http"), 
+                   "wsgi.input": io.BytesIO(), 
+                   "wsgi.errors": sys.stderr, 
+                   "wsgi.multithread": True, 
+                   "wsgi.multiprocess": False, 
+                   "wsgi.run_once": False}
+        for name, value in scope.get("headers", []):
+            key = "HTTP_%s" % name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if key in environ:
+                environ[key] += ",%s" % value
+            else:
+                environ[key] = value
+        for key in ["CONTENT_TYPE", "CONTENT_LENGTH"]:
+            if ("HTTP_%s" % key) in environ:
+                environ[key] = environ.pop("HTTP_%s" % key)
+        return environ
+    
+    def nextChunk(self, pageIterator):
+        """Run (in the executor) the page generator until it has yielded enough output to send.
+        Return None when the page is finished."""
+        parts = []
+        size = 0
+        deadline = time.time() + self.chunkSeconds
+        for part in pageIterator:
+            if isinstance(part, str):
+                part = part.encode("utf-8")
+            parts.append(part)
+            size += len(part)
+            if size >= self.chunkSize or time.time() >= deadline:
+                break
+        return b"".join(parts) if len(parts) > 0 else None
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        loop = asyncio.get_running_loop()
+        response = {}
+        def startResponse(status, headers, exc_info = None):
+            response["status"] = int(status.split()[0])
+            response["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1")) 
+                                   for name, value in headers]
+        pageIterator = iter(AptrowApp(self.wsgiEnviron(scope), startResponse))
+        try:
+            chunk = await loop.run_in_executor(self.executor, self.nextChunk, pageIterator)
+            await send({"type": "http.response.start", 
+                        "status": response.get("status", 500), 
+                        "headers": response.get("headers", [])})
+            while chunk != None:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                chunk = await loop.run_in_executor(self.executor, self.nextChunk, pageIterator)
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            close = getattr(pageIterator, "close", None)
+            if close != None:
+                await loop.run_in_executor(self.executor, close)
+
+def runAptrowServer(host, port, mode = "simple", workers = 8, queueSize = 64, keepAlive = False, idleTimeout = 15, 
+                    pageCacheBytes = 32 * 1024 * 1024):
+    """Run AptrowApp as a web server. Mode "simple" handles one request at a time; 
+    mode "threaded" handles requests on a pool of 'workers' threads, with at most 
+    'queueSize' accepted connections waiting for a free worker; mode "prefork" handles
+    requests in 'workers' processes forked from this one (see wsgi_servers.PreforkServer);
+    mode "asyncio" serves AptrowAsgiApp from an asyncio event loop, with 'workers' executor threads.
+    If keepAlive is True, the (non-asyncio) server keeps HTTP/1.1 connections open between requests,
+    until they have been idle for 'idleTimeout' seconds.
+    Rendered pages are cached in pageCache, up to a total of 'pageCacheBytes' bytes (0 to disable)."""
+    pageCache.maxBytes = pageCacheBytes
+    spillFileCache.removeLeftoverDirs()
+    if mode == "asyncio":
+        from asyncio_server import AsyncioHttpServer
+        httpd = AsyncioHttpServer(host, port, AptrowAsgiApp(executorThreads = workers), backlog = queueSize)
+    else:
+        from wsgi_servers import makeServer
+        httpd = makeServer(host, port, wsgiApplication, mode = mode, workers = workers, queueSize = queueSize, 
+                           keepAlive = keepAlive, idleTimeout = idleTimeout)
+        if mode == "prefork":
+            httpd.onWorkerExit = spillFileCache.removeProcessDir
+    print("Serving HTTP on http://%s:%s/ (%s mode) ..." % (host, port, mode))
 
     # Respond to requests until process is killed
     httpd.serve_forever()
@@ -238,10 +522,13 @@ class ResourceInterface:
     define @interpretationOf-decorated (static) methods in the resource classes providing the interpretations.
     """
     def __init__(self):
-        self.interpretationMethods = []
+        self.interpretationMethods = ()
         
     def addInterpretation(self, method):
-        self.interpretationMethods.append(method)
+        """Add an interpretation method. (The tuple of methods is replaced rather than
+        modified, so that getInterpretationsOf never needs to take the lock.)"""
+        with registryLock:
+            self.interpretationMethods = self.interpretationMethods + (method,)
         
     def getInterpretationsOf(self, resource):
         return [method(resource) for method in self.interpretationMethods]
@@ -304,6 +591,12 @@ class View:
             dict["view.%s" % key] = value
         return dict
     
+    def urlQuery(self):
+        """URL query string for this view (computed once)"""
+        if not hasattr(self, "queryString"):
+            self.queryString = urllib.parse.urlencode(self.htmlParamsDict())
+        return self.queryString
+    
 class MethodsByViewType:
     """A dictionary of methods retrieved by view type. 
     Throws UnknownViewTypeException if view type is unknown.
@@ -359,12 +652,44 @@ class AptrowQueryParams:
     'attributes' to emphasise their read-only nature. """
     
     def __init__(self, htmlParams):
+        """Parse the parameters (as returned by urllib.parse.parse_qs) once, into base parameters, 
+        the chain of attribute lookups, and view parameters. (Only the first value of each
+        parameter is used.)"""
         self.htmlParams = htmlParams
+        self.baseParams = {}
+        self.viewType = None
+        self.viewParams = {}
+        attributeNames = {}
+        attributeParamsByNumber = {}
+        for key, values in htmlParams.items():
+            value = values[0]
+            if key.startswith("_"):
+                number, dot, name = key[1:].partition(".")
+                if dot == "":
+                    attributeNames[number] = value
+                else:
+                    attributeParamsByNumber.setdefault(number, {})[name] = value
+            elif key == "view":
+                self.viewType = value
+            elif key.startswith("view."):
+                self.viewParams[key[len("view."):]] = value
+            else:
+                self.baseParams[key] = value
+        self.attributeChain = []
+        count = 1
+        while ("%s" % count) in attributeNames:
+            number = "%s" % count
+            self.attributeChain.append((attributeNames[number], attributeParamsByNumber.get(number, {})))
+            count += 1
+            
+    @staticmethod
+    def fromQuery(query):
+        """Parse a URL query string"""
+        return AptrowQueryParams(urllib.parse.parse_qs(query))
         
     def getString(self, name):
         """Retrieve an optional base resource parameter by name."""
-        valuesArray = self.htmlParams.get(name)
-        return None if valuesArray == None else valuesArray[0]
+        return self.baseParams.get(name)
     
     def getRequiredString(self, name):
         """Retrieve a required base resource parameter by name."""
@@ -375,38 +700,41 @@ class AptrowQueryParams:
     
     def attributesAndParams(self):
         """Extract attribute parameters as a list of pairs of names and parameter dicts."""
-        count = 1
-        finished = False
-        while not finished:
-            attributeKey = "_%s" % count
-            attribute = self.getString(attributeKey)
-            if attribute == None:
-                finished = True
-            else:
-                yield (attribute, self.attributeParams(count))
-                count += 1
+        return self.attributeChain
                 
     def attributeParams(self, count):
         """For a given attribute lookup (identified by number from 1 up), retrieve parameters
         for that lookup into a dict."""
-        params = {}
-        for key, value in self.htmlParams.items():
-            prefix = "_%s." % count
-            if key.startswith(prefix):
-                params[key[len(prefix):]] = value[0]
-        return params
+        return self.attributeChain[count-1][1] if count <= len(self.attributeChain) else {}
     
     def getView(self, defaultType = None):
         """Get the View object defined by the 'view' and 'view.<param>' URL parameters."""
-        type = self.getString("view")
-        if type == None:
+        if self.viewType == None:
             return None
         else:
-            params = {}
-            for key, value in self.htmlParams.items():
-                if key.startswith("view."):
-                    params[key[len("view."):]] = value[0]
-            return View(type, params)
+            return View(self.viewType, dict(self.viewParams))
+        
+    def canonicalResourceQuery(self):
+        """Canonical query string for the resource (ignoring the view): base parameters in name order, 
+        followed by the attribute chain in order, each with its parameters in name order. 
+        Parameters which play no part in finding the resource are left out."""
+        params = sorted(self.baseParams.items())
+        count = 1
+        for attribute, attributeParams in self.attributeChain:
+            params.append(("_%s" % count, attribute))
+            for name, value in sorted(attributeParams.items()):
+                params.append(("_%s.%s" % (count, name), value))
+            count += 1
+        return urllib.parse.urlencode(params)
+    
+    def canonicalQuery(self):
+        """Canonical query string for the resource and view (suitable for use as a cache key)"""
+        query = self.canonicalResourceQuery()
+        if self.viewType != None:
+            viewParams = [("view", self.viewType)] + [("view.%s" % name, value) 
+                                                      for name, value in sorted(self.viewParams.items())]
+            query += "&%s" % urllib.parse.urlencode(viewParams)
+        return query
     
 class NoSuchObjectException(MessageException):
     """Thrown when a Resource has been created and is then later found not to represent a valid resource. 
@@ -448,6 +776,10 @@ class StringParam(Param):
         """Get the string which represents the value (i.e. inverse of getValueFromString)"""
         return value
     
+    def getQuotedStringFromValue(self, value):
+        """Get the string which represents the value, quoted for inclusion in a URL"""
+        return urllib.parse.quote_plus(value)
+    
     def label(self):
         return "String"
     
@@ -465,6 +797,11 @@ class ResourceParam(Param):
     def getStringFromValue(self, value):
         """Get the string which represents the value (i.e. inverse of getValueFromString)"""
         return value.url()
+    
+    def getQuotedStringFromValue(self, value):
+        """Get the string which represents the value, quoted for inclusion in a URL 
+        (the resource's quoted URL is only computed once)"""
+        return value.quotedUrl()
 
     def label(self):
         return "Resource"
@@ -477,6 +814,169 @@ def getResourceParams(queryParams, paramDefinitions):
     return [paramDefinition.getValue(queryParams.getString(paramDefinition.name)) 
             for paramDefinition in paramDefinitions]
   
+class Validator:
+    """Identifies the current version of the source(s) that a resource is presented from, 
+    so that a client (or cache) can tell whether its copy of a page is still current. 
+    'token' is any value (a tuple of strings and numbers, whose repr is stable) which changes
+    whenever the source changes. 'lastModified' is the time of the last change (if known)."""
+    
+    def __init__(self, token, lastModified = None):
+        self.token = token
+        self.lastModified = lastModified
+        
+    def etag(self, url):
+        """Strong ETag for the page at url (including view) presented from this version of the source"""
+        return "\"%s\"" % hashlib.sha1(repr((url, self.token)).encode("utf-8")).hexdigest()
+    
+    def combinedWith(self, other):
+        """Validator for something depending on the sources of this validator and another"""
+        if other == None:
+            return None
+        if self.lastModified == None or other.lastModified == None:
+            lastModified = None
+        else:
+            lastModified = max(self.lastModified, other.lastModified)
+        return Validator((self.token, other.token), lastModified)
+    
+def fileValidator(path):
+    """Validator for a file or directory on the local file system (from its size and modification time)"""
+    fileStat = os.stat(path)
+    return Validator(("file", path, fileStat.st_size, fileStat.st_mtime_ns), fileStat.st_mtime)
+
+class PageRecording:
+    """Record of the sources that a page depends on, each as a resource and view, and the token of 
+    the resource's validator for that view at the time the page was rendered. A page can only be 
+    cached if all of its sources have validators (see Resource.validator)."""
+    
+    def __init__(self):
+        self.sources = []
+        self.cacheable = True
+        
+    def record(self, resource, view):
+        validator = resource.validator(view)
+        if validator == None:
+            self.cacheable = False
+        else:
+            self.sources.append((resource, view, validator.token))
+            
+    def isCurrent(self):
+        """Do all the sources still have the same validators? (Not if any of them no longer exist.)"""
+        try:
+            for resource, view, token in self.sources:
+                validator = resource.validator(view)
+                if validator == None or validator.token != token:
+                    return False
+            return True
+        except (OSError, MessageException):
+            return False
+        
+"""The recording of the page currently being rendered by each thread (see AptrowApp.cachedPage)"""
+pageRecordings = threading.local()
+
+def recordPageSource(resource, view):
+    """Record that the page currently being rendered depends on another resource (as presented 
+    in the given view). A resource whose page depends on sources other than itself must either 
+    have a validator which covers all of them, or record them while rendering (in which case 
+    its 'recordsPageSources' method must return True)."""
+    recording = getattr(pageRecordings, "current", None)
+    if recording != None:
+        recording.record(resource, view)
+        
+def markPageUncacheable():
+    """Record that the page currently being rendered must not be cached (for example, if it shows an error)"""
+    recording = getattr(pageRecordings, "current", None)
+    if recording != None:
+        recording.cacheable = False
+        
+class CachedPage:
+    """A rendered page held in pageCache: status, headers and body, and the recording of its sources"""
+    
+    def __init__(self, status, headers, parts, recording):
+        self.status = status
+        self.body = b"".join([part.encode("utf-8") if isinstance(part, str) else part for part in parts])
+        self.headers = [(name, value) for name, value in headers if name.lower() != "content-length"]
+        self.headers.append(('Content-Length', str(len(self.body))))
+        self.recording = recording
+        
+class PageCache:
+    """Cache of rendered pages, keyed by resource URL (including the view). On lookup, the validators
+    of the page's sources are checked, and a page whose sources have changed is discarded. 
+    Least recently used pages are evicted to keep the total size of the cached pages within 'maxBytes'
+    (and a page bigger than 1/'maxPageFraction' of that is not cached at all)."""
+    
+    maxPageFraction = 8
+    
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.pages = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.totalBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.staleMisses = 0
+        self.evictions = 0
+        
+    def maxPageBytes(self):
+        return self.maxBytes // self.maxPageFraction
+        
+    def get(self, key):
+        """Return the cached page for key, if there is one and it is still current, otherwise None"""
+        with self.lock:
+            page = self.pages.get(key)
+            if page == None:
+                self.misses += 1
+                return None
+        if not page.recording.isCurrent():
+            with self.lock:
+                if self.pages.get(key) is page:
+                    self.removePage(key)
+                self.misses += 1
+                self.staleMisses += 1
+            return None
+        with self.lock:
+            if key in self.pages:
+                self.pages.move_to_end(key)
+            self.hits += 1
+        return page
+    
+    def put(self, key, page):
+        if len(page.body) > self.maxPageBytes():
+            return
+        with self.lock:
+            if key in self.pages:
+                self.removePage(key)
+            self.pages[key] = page
+            self.totalBytes += len(page.body)
+            while self.totalBytes > self.maxBytes:
+                self.removePage(next(iter(self.pages)))
+                self.evictions += 1
+                
+    def removePage(self, key):
+        """Remove a page (with the lock held)"""
+        page = self.pages.pop(key)
+        self.totalBytes -= len(page.body)
+        
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+            self.totalBytes = 0
+        
+    def stats(self):
+        """Return a dict of statistics about this cache"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"pages": len(self.pages), 
+                    "bytes": self.totalBytes, 
+                    "maxBytes": self.maxBytes, 
+                    "hits": self.hits, 
+                    "misses": self.misses, 
+                    "staleMisses": self.staleMisses, 
+                    "hitRatio": float(self.hits) / lookups if lookups > 0 else 0.0, 
+                    "evictions": self.evictions}
+    
+"""Cache of rendered pages (see AptrowApp.cachedPage). Its size can be set by runAptrowServer."""
+pageCache = PageCache(32 * 1024 * 1024)
+
 def attribute(*params):
     """Decorator for attribute methods"""
     def decorator(func):
@@ -484,13 +984,44 @@ def attribute(*params):
         return func
     return decorator
 
-class Resource:
-    """Base class for all resources handled and retrieved by the application."""
+"""Resources currently in existence, by class and args (see InternedResourceClass)"""
+internedResources = weakref.WeakValueDictionary()
+internLock = threading.RLock()
+
+class InternedResourceClass(type):
+    """Metaclass for resource classes, which interns resources: creating a resource with the same 
+    class and args as an existing resource returns the existing resource. So each resource is only 
+    initialised once (and its URL only constructed once), however many times it is referred to."""
+    
+    def __call__(resourceClass, *args):
+        key = (resourceClass, args)
+        try:
+            with internLock:
+                resource = internedResources.get(key)
+                if resource == None:
+                    resource = type.__call__(resourceClass, *args)
+                    internedResources[key] = resource
+                return resource
+        except TypeError: # some arg is unhashable, so don't intern
+            return type.__call__(resourceClass, *args)
+
+class Resource(metaclass = InternedResourceClass):
+    """Base class for all resources handled and retrieved by the application.
+    Resources are immutable (and interned, so that one resource object may be shared between 
+    many requests and threads): attributes can only be set by the 'init' method. 
+    (Values computed later and cached must be stored directly in self.__dict__.)"""
     
     def __init__(self, *args):
         self.module = None
         self.args = args
+        self.resourceParamValues = list(args) # record parameters passed in
         self.init(*args) # have to define init method for each Resource Class
+        self.__dict__["initialised"] = True
+        
+    def __setattr__(self, name, value):
+        if self.__dict__.get("initialised"):
+            raise AttributeError("Cannot set attribute %r of immutable resource [%s]" % (name, self.heading()))
+        object.__setattr__(self, name, value)
         
     def urlParams(self):
         """Parameters required to construct the URL for this resource.
@@ -511,6 +1042,18 @@ class Resource:
         """
         pass
     
+    def validator(self, view):
+        """Return a Validator identifying the current version of the source(s) of this resource as 
+        presented in the given view, or None (the default) if there isn't a cheap way to tell when
+        the presentation would change. (Note: the resource's URL is always included in a
+        validator's ETag, so it is only necessary to identify changes to external sources.)"""
+        return None
+    
+    def recordsPageSources(self, view):
+        """Does the page for this view record all the sources it depends on by calling recordPageSource
+        (so that it can be cached even though the resource itself has no validator)? Default: no."""
+        return False
+    
     def getInterpretations(self):
         interpretations = aptrowResource.getInterpretationsOf(self)
         if hasattr(self.__class__, "resourceInterfaces"):
@@ -546,6 +1089,11 @@ class Resource:
     
     def page(self, app, view):
         for element in self.htmlPage(app, view): yield tag.toString(element)
+        
+    def fileResult(self, app, view):
+        """Override to return a WSGI result other than the output of page(), such as a file wrapped 
+        in 'wsgi.file_wrapper' (calling app.start() first). Default: None, meaning use page()."""
+        return None
     
     def htmlPage(self, app, view):
         """Return the web page for the resource. Default is to return an HTML page
@@ -553,7 +1101,7 @@ class Resource:
         if something else is required. Note that currently this application does
         not take any notice of requested content types.)"""
         heading = self.heading()
-        response_headers = [('Content-Type','text/html')]
+        response_headers = [('Content-Type','text/html; charset=utf-8')]
         app.start('200 OK', response_headers)
         yield "<html><head><title>%s</title></head><body>" % h(heading)
         yield app.message
@@ -563,6 +1111,7 @@ class Resource:
             for text in self.html(view): yield text
         except BaseException as error:
             traceback.print_exc()
+            markPageUncacheable()
             yield "<div class =\"aptrowError\">Error: %s</div>" % (h(str(error)),)
         yield "</body></html>"
         
@@ -605,17 +1154,42 @@ class Resource:
         else:
             return ""
 
+    def baseUrl(self):
+        """ Construct URL for this resource, from registered resource type and parameter
+        values (computed once, as the resource is immutable)"""
+        urlString = self.__dict__.get("urlString")
+        if urlString == None:
+            resourceUrlPrefix = getattr(self.__class__, "resourceUrlPrefix", None)
+            if resourceUrlPrefix == None:
+                resourceUrlPrefix = "%s/%s" % (self.modulePrefix(), self.__class__.resourcePath)
+            quotedParams = ["%s=%s" % (urllib.parse.quote_plus(resourceParam.name), 
+                                       resourceParam.getQuotedStringFromValue(arg))
+                            for resourceParam, arg in zip(self.__class__.resourceParams, self.args)
+                            if arg != None]
+            urlString = "%s?%s" % (resourceUrlPrefix, "&".join(quotedParams))
+            self.__dict__["urlString"] = urlString
+        return urlString
+    
+    def quotedUrl(self):
+        """The URL for this resource quoted for inclusion in another URL (computed once)"""
+        quotedUrlString = self.__dict__.get("quotedUrlString")
+        if quotedUrlString == None:
+            quotedUrlString = urllib.parse.quote_plus(self.baseUrl())
+            self.__dict__["quotedUrlString"] = quotedUrlString
+        return quotedUrlString
+
     def url(self, attributesAndParams = [], view = None):
         """ Construct URL for this resource, from registered resource type and parameter
         values from urlParams(). Any supplied attribute lookups are added to the end of the URL."""
-        urlString = "%s/%s?%s" % (self.modulePrefix(), self.__class__.resourcePath, 
-                                urllib.parse.urlencode(self.urlParams(), True))
+        urlString = self.baseUrl()
+        if len(attributesAndParams) == 0 and view == None:
+            return urlString
         count = 1
         for attribute,params in attributesAndParams:
             urlString += "&%s" % urllib.parse.urlencode(self.attributeUrlParams(attribute, count, params))
             count += 1
         if view != None:
-            urlString += "&%s" % urllib.parse.urlencode(view.htmlParamsDict())
+            urlString += "&%s" % view.urlQuery()
         return urlString
     
     def formActionParamsAndCount(self, attributesAndParams = []):
@@ -662,28 +1236,252 @@ class FileContents(Resource):
     def checkExists(self):
         """This resource exists if the file resource exists."""
         self.file.checkExists()
+        
+    def validator(self, view):
+        return self.file.validator(None)
+    
+    chunkSize = 65536
+    
+    def responseHeaders(self, size, contentType = None):
+        """Headers for a response of known size"""
+        if contentType == None:
+            contentType = self.contentType
+        response_headers = [('Content-Length', str(size)), ('Accept-Ranges', 'bytes')]
+        if contentType != None:
+            response_headers.append(('Content-Type', contentType))
+        return response_headers
+    
+    def fileResult(self, app, view):
+        """If the whole of a file on the local file system is requested, and the server provides
+        'wsgi.file_wrapper', return the wrapped file."""
+        fileWrapper = app.environ.get('wsgi.file_wrapper')
+        if fileWrapper == None or app.environ.get('HTTP_RANGE') != None or not hasattr(self.file, "path"):
+            return None
+        f = self.file.openBinaryFile()
+        try:
+            size = os.fstat(f.fileno()).st_size
+        except:
+            f.close()
+            raise
+        app.start('200 OK', self.responseHeaders(size))
+        return fileWrapper(f, FileContents.chunkSize)
     
     def page(self, app, view):
-        """Override default page() method to send contents directly with content type (if specified)."""
-        response_headers = []
-        if self.contentType != None:
-            response_headers.append(('Content-Type', self.contentType))
-        app.start('200 OK', response_headers)
+        """Override default page() method to send contents directly with content type (if specified).
+        Contents are sent in chunks, as they are read. If the size of the contents is known, it is sent
+        as Content-Length, and single or multiple byte ranges can be requested with a Range header."""
         with self.file.openBinaryFile() as f:
-            yield f.read()
+            size = openFileSize(f)
+            rangeHeader = app.environ.get('HTTP_RANGE')
+            ranges = None
+            if size != None and rangeHeader != None and f.seekable():
+                ranges = parseByteRanges(rangeHeader, size)
+            if size == None:
+                response_headers = []
+                if self.contentType != None:
+                    response_headers.append(('Content-Type', self.contentType))
+                app.start('200 OK', response_headers)
+                chunks = self.readChunks(f, None)
+            elif ranges == None:
+                app.start('200 OK', self.responseHeaders(size))
+                chunks = self.readChunks(f, size)
+            elif len(ranges) == 0:
+                app.start('416 Range Not Satisfiable', [('Content-Length', '0'), 
+                                                        ('Content-Range', 'bytes */%s' % size)])
+                chunks = []
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                response_headers = self.responseHeaders(end-start+1)
+                response_headers.append(('Content-Range', 'bytes %s-%s/%s' % (start, end, size)))
+                app.start('206 Partial Content', response_headers)
+                f.seek(start)
+                chunks = self.readChunks(f, end-start+1)
+            else:
+                chunks = self.multipartRanges(app, f, ranges, size)
+            for data in chunks:
+                yield data
+                
+    def readChunks(self, f, length):
+        """Read chunks from file, up to length bytes (or to the end if length is None)"""
+        while length == None or length > 0:
+            data = f.read(FileContents.chunkSize if length == None else min(length, FileContents.chunkSize))
+            if len(data) == 0:
+                break
+            if length != None:
+                length -= len(data)
+            yield data
             
-import tempfile
+    def multipartRanges(self, app, f, ranges, size):
+        """Start a multipart/byteranges response, and return generator of its content"""
+        boundary = "aptrow_%s" % uuid.uuid4().hex
+        partContentType = self.contentType if self.contentType != None else "application/octet-stream"
+        partHeaders = [("\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %s-%s/%s\r\n\r\n" 
+                        % (boundary, partContentType, start, end, size)).encode("ascii")
+                       for start, end in ranges]
+        closing = ("\r\n--%s--\r\n" % boundary).encode("ascii")
+        length = (sum(len(partHeader) for partHeader in partHeaders) + len(closing) 
+                  + sum(end-start+1 for start, end in ranges))
+        app.start('206 Partial Content', 
+                  self.responseHeaders(length, "multipart/byteranges; boundary=%s" % boundary))
+        def parts():
+            for partHeader, (start, end) in zip(partHeaders, ranges):
+                yield partHeader
+                f.seek(start)
+                for data in self.readChunks(f, end-start+1):
+                    yield data
+            yield closing
+        return parts()
+    
+def openFileSize(f):
+    """Size of an open binary file (or None if it can't be determined without reading it)"""
+    size = getattr(f, "size", None)
+    if size == None:
+        if isinstance(f, io.BytesIO):
+            size = f.getbuffer().nbytes
+        else:
+            try:
+                size = os.fstat(f.fileno()).st_size
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                pass
+    return size
+
+def parseByteRanges(rangeHeader, size):
+    """Parse the value of a Range header for content of given size, returning a list of (start, end) 
+    pairs (end inclusive), or None if the header is invalid (and should be ignored). 
+    An empty list means none of the ranges can be satisfied."""
+    unit, equals, rangeSpecs = rangeHeader.partition("=")
+    if unit.strip() != "bytes" or equals == "":
+        return None
+    ranges = []
+    for rangeSpec in rangeSpecs.split(","):
+        first, dash, last = rangeSpec.strip().partition("-")
+        if dash == "" or not (first.isdigit() or first == "") or not (last.isdigit() or last == ""):
+            return None
+        if first == "":
+            if last == "":
+                return None
+            suffixLength = int(last)
+            if suffixLength > 0:
+                ranges.append((max(size-suffixLength, 0), size-1))
+        else:
+            start = int(first)
+            end = size-1 if last == "" else min(int(last), size-1)
+            if last != "" and int(last) < start:
+                return None
+            if start < size:
+                ranges.append((start, end))
+    return ranges
             
+import tempfile
+import shutil
+import atexit
+
+class SpillFileCache:
+    """Copies of the contents of 'file-like' resources written out as real files (for code which needs 
+    a path, such as sqlite3.connect), keyed by the resource's URL and the token of its validator, so that 
+    one copy is reused for as long as its source is unchanged. (A resource without a validator is copied 
+    every time.) Each copy is in a sub-directory named by a hash of its key (so that it keeps its 
+    own file name), within a directory for the current process under 'rootDir'. The least recently used 
+    copies are deleted to keep their total size within 'diskQuota' bytes. Directories left by processes
+    which no longer exist are deleted at startup, and the process's own directory when it exits (or, for 
+    a pre-fork worker, by the parent once the worker has exited, see removeProcessDir)."""
+    
+    def __init__(self, rootDir = None, diskQuota = 1024*1024*1024):
+        self.rootDir = rootDir if rootDir != None else os.path.join(tempfile.gettempdir(), "aptrow_spill")
+        self.diskQuota = diskQuota
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.diskUsed = 0
+        self.processId = None
+        self.processDir = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+    def getProcessDir(self):
+        """The directory for copies made by this process (created when first needed, and again
+        in a process forked after it was created)"""
+        with self.lock:
+            if self.processId != os.getpid():
+                self.processId = os.getpid()
+                self.processDir = os.path.join(self.rootDir, "pid-%s" % self.processId)
+                self.entries.clear()
+                self.diskUsed = 0
+                shutil.rmtree(self.processDir, True)
+                os.makedirs(self.processDir)
+                atexit.register(shutil.rmtree, self.processDir, True)
+            return self.processDir
+        
+    def removeProcessDir(self, processId):
+        """Delete the directory of copies made by another process which has exited (such as a pre-fork 
+        worker, which exits without running exit handlers)"""
+        shutil.rmtree(os.path.join(self.rootDir, "pid-%s" % processId), True)
+        
+    def removeLeftoverDirs(self):
+        """Delete directories of copies made by processes which no longer exist"""
+        if os.name != "posix" or not os.path.isdir(self.rootDir): # (no safe way to check other processes)
+            return
+        for name in os.listdir(self.rootDir):
+            if name.startswith("pid-") and name[len("pid-"):].isdigit():
+                try:
+                    os.kill(int(name[len("pid-"):]), 0)
+                except ProcessLookupError:
+                    shutil.rmtree(os.path.join(self.rootDir, name), True)
+                except PermissionError: # exists, but belongs to someone else
+                    pass
+                
+    def getPath(self, fileResource):
+        """Path of a copy of the resource's current contents (written now if there isn't one already)"""
+        validator = fileResource.validator(None)
+        if validator != None:
+            key = (fileResource.url(), validator.token)
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry != None and self.processId == os.getpid() and os.path.exists(entry[0]):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+        else:
+            key = (fileResource.url(), uuid.uuid4().hex)
+        processDir = self.getProcessDir()
+        with self.lock:
+            self.misses += 1
+        copyDir = os.path.join(processDir, hashlib.sha1(repr(key).encode("utf-8")).hexdigest())
+        os.makedirs(copyDir, exist_ok = True)
+        path = os.path.join(copyDir, fileResource.getFileName())
+        writingPath = "%s.%s.tmp" % (path, threading.get_ident())
+        with fileResource.openBinaryFile() as inFile:
+            with open(writingPath, "wb") as outFile:
+                shutil.copyfileobj(inFile, outFile, 1024*1024)
+                size = outFile.tell()
+        os.replace(writingPath, path)
+        deletedDirs = []
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (path, size)
+                self.diskUsed += size
+            while self.diskUsed > self.diskQuota and len(self.entries) > 1:
+                oldKey, (oldPath, oldSize) = self.entries.popitem(last = False)
+                self.diskUsed -= oldSize
+                self.evictions += 1
+                deletedDirs.append(os.path.dirname(oldPath))
+        for deletedDir in deletedDirs:
+            shutil.rmtree(deletedDir, True) # (a copy still open on Windows is left until exit)
+        return path
+    
+    def stats(self):
+        with self.lock:
+            return {"files": len(self.entries), "diskUsed": self.diskUsed, "diskQuota": self.diskQuota, 
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+    
+"""Copies of 'file-like' resources needed as real files (see getFileResourcePath)"""
+spillFileCache = SpillFileCache()
+
 def getFileResourcePath(fileResource):
     """Get path of file from 'file-like' resource, either 
-    from .path attribute, or from getFileName() & openBinaryFile()"""
+    from .path attribute, or from getFileName() & openBinaryFile()
+    (copied to a file in spillFileCache, which is reused while the resource is unchanged)"""
     if hasattr(fileResource, "path"):
         return fileResource.path
     else:
-        tempDir = tempfile.mkdtemp(prefix = "aptrow_")
-        tempFileName = os.path.join(tempDir, fileResource.getFileName())
-        with fileResource.openBinaryFile() as inFile:
-            fileContents = inFile.read()
-            with open(tempFileName, "wb") as outFile:
-                outFile.write(fileContents)
-        return tempFileName
+        return spillFileCache.getPath(fileResource)
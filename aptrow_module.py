@@ -34,7 +34,28 @@ class AptrowResource(Resource):
         yield tag.P("Information about the Aptrow application")
         yield tag.H2("Resource modules")
         yield tag.UL([tag.LI(tag.A(h(prefix), href = ResourceModuleResource(prefix).url()))
-                      for prefix, resourceModule in resourceModules.items()])
+                      for prefix, resourceModule in registeredResourceModules()])
+        yield tag.H2("Page cache")
+        stats = pageCache.stats()
+        yield statsTable([("Pages", stats["pages"]), 
+                          ("Bytes", "%s (of maximum %s)" % (stats["bytes"], stats["maxBytes"])), 
+                          ("Hits", stats["hits"]), 
+                          ("Misses", "%s (including %s stale)" % (stats["misses"], stats["staleMisses"])), 
+                          ("Hit ratio", "%.1f%%" % (stats["hitRatio"] * 100)), 
+                          ("Evictions", stats["evictions"])])
+        yield tag.H2("Spilled file copies")
+        stats = spillFileCache.stats()
+        yield statsTable([("Files", stats["files"]), 
+                          ("Bytes", "%s (of quota %s)" % (stats["diskUsed"], stats["diskQuota"])), 
+                          ("Hits", stats["hits"]), 
+                          ("Misses", stats["misses"]), 
+                          ("Evictions", stats["evictions"])])
+        
+def statsTable(labelsAndValues):
+    """HTML table of cache statistics"""
+    return tag.TABLE(tag.TBODY([tag.TR(tag.TD(h(label)), tag.TD(h(str(value)))) 
+                                for label, value in labelsAndValues]), 
+                     border = 1)
         
 @resourceTypeNameInModule("module", aptrowModule)
 class ResourceModuleResource(Resource):
@@ -61,7 +82,7 @@ class ResourceModuleResource(Resource):
                         tag.TBODY([tag.TR(tag.TD(tag.A(h(resourceType), 
                                                        href = ResourceTypeResource(self.prefix, resourceType).url())), 
                                           tag.TD(h(resourceClass.__name__)))
-                                   for resourceType, resourceClass in resourceModule.classes.items()]), 
+                                   for resourceType, resourceClass in resourceModule.resourceClasses()]), 
                         border = 1)
 
 @resourceTypeNameInModule("resourceType", aptrowModule)
@@ -28,9 +28,19 @@ addModule ("sqlite",  "sqlite_module")
 # SECURITY NOTE: This demo application gives read-only access to all files and directories
 # on the local filesystem which can be accessed by the user running the application. So beware.
 #
-# (Also, this application may create temporary files which it does not delete, which are copies
-#  of the contents of 'file-like' objects which are not themselves files.)
+# (Also, this application creates temporary files, in aptrow_spill under the system temporary directory,
+#  which are copies of the contents of 'file-like' objects which are not themselves files. 
+#  They are deleted on exit, or, if the process is killed, the next time the server starts.)
+#
+# Server modes: "simple" (one request at a time), "threaded" (a pool of 'workers' threads,
+# with up to 'queueSize' accepted connections waiting for a free worker) or "prefork"
+# ('workers' processes sharing the listening socket; send SIGUSR1 to the parent for a health report)
+# or "asyncio" (an event loop, with 'workers' threads doing the blocking work of producing pages).
+# keepAlive = True keeps HTTP/1.1 connections open for further requests (until idle for 'idleTimeout'
+# seconds), which is best combined with "threaded" mode, as each open connection occupies a worker.
+# Rendered pages are cached (and checked against their sources on each request) up to pageCacheBytes.
         
-runAptrowServer('localhost', 8000)
+runAptrowServer('localhost', 8000, mode = "threaded", workers = 8, queueSize = 64, keepAlive = True, idleTimeout = 15, 
+                pageCacheBytes = 32 * 1024 * 1024)
 
 # suggested starting URL: http://localhost:8000/files/dir?path=c:\
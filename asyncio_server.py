@@ -0,0 +1,114 @@
+""" Copyright 2009 Philip Dorrell http://www.1729.com/ (email: http://www.1729.com/email.html)
+
+  This file is part of Aptrow ("Advance Programming Technology Read-Only Webification": http://www.1729.com/aptrow/)
+
+  Aptrow is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+  as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+  Aptrow is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+  of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License along with Aptrow (as license-gplv3.txt).
+  If not, see <http://www.gnu.org/licenses/>."""
+
+"""A minimal asyncio HTTP server for running an ASGI application (such as aptrow.AptrowAsgiApp)
+without any third-party server. (AptrowAsgiApp can equally be run by any other ASGI server.)"""
+
+import asyncio
+import http.client
+import urllib.parse
+
+class AsyncioHttpServer:
+    """HTTP server running one coroutine per connection on a single event loop. Each connection
+    handles one request and is then closed. A client which doesn't send a complete request
+    within 'requestTimeout' seconds is disconnected."""
+
+    requestTimeout = 60
+    maxRequestHeadSize = 65536
+
+    def __init__(self, host, port, app, backlog = 100):
+        self.host = host
+        self.port = port
+        self.app = app
+        self.backlog = backlog
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handleConnection, self.host, self.port,
+                                            backlog = self.backlog, limit = self.maxRequestHeadSize)
+        async with server:
+            await server.serve_forever()
+
+    async def readRequestHead(self, reader):
+        """Read request line and headers, returning (method, target, version, headers), or None
+        if the client closed the connection (or sent something unparseable)"""
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            return None
+        lines = head.decode("latin-1").split("\r\n")
+        requestLine = lines[0].split()
+        if len(requestLine) != 3:
+            return None
+        method, target, version = requestLine
+        headers = []
+        for line in lines[1:]:
+            if line != "":
+                name, colon, value = line.partition(":")
+                headers.append((name.strip().lower().encode("latin-1"), value.strip().encode("latin-1")))
+        return method, target, version, headers
+
+    def makeScope(self, method, target, version, headers, writer):
+        path, questionMark, query = target.partition("?")
+        return {"type": "http",
+                "asgi": {"version": "3.0"},
+                "http_version": version[len("HTTP/"):],
+                "method": method,
+                "scheme": "http",
+                "path": urllib.parse.unquote(path),
+                "raw_path": path.encode("latin-1"),
+                "query_string": query.encode("latin-1"),
+                "root_path": "",
+                "headers": headers,
+                "client": writer.get_extra_info("peername"),
+                "server": (self.host, self.port)}
+
+    async def handleConnection(self, reader, writer):
+        try:
+            try:
+                requestHead = await asyncio.wait_for(self.readRequestHead(reader), self.requestTimeout)
+            except asyncio.TimeoutError:
+                return
+            if requestHead == None:
+                return
+            method, target, version, headers = requestHead
+            scope = self.makeScope(method, target, version, headers, writer)
+
+            requestSent = [False]
+            async def receive():
+                if not requestSent[0]:
+                    requestSent[0] = True
+                    return {"type": "http.request", "body": b"", "more_body": False}
+                await writer.wait_closed()
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                    lines = ["HTTP/1.1 %s %s" % (status, http.client.responses.get(status, "")),
+                             "Connection: close"]
+                    for name, value in message.get("headers", []):
+                        lines.append("%s: %s" % (name.decode("latin-1"), value.decode("latin-1")))
+                    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+                elif message["type"] == "http.response.body":
+                    writer.write(message.get("body", b""))
+                    await writer.drain()
+
+            await self.app(scope, receive, send)
+            print("%s - \"%s %s %s\"" % (scope["client"][0] if scope["client"] else "-", method, target, version))
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
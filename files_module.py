@@ -12,10 +12,234 @@
   If not, see <http://www.gnu.org/licenses/>."""
 
 from aptrow import *
+import concurrent.futures
+from lrucache import LruCache
+from inotify_watcher import openDirectoryWatcher
 
 # Aptrow module giving access to files and directories in the local file system
 
 aptrowModule = ResourceModule()
+
+class DirectoryEntry:
+    """An entry in a directory listing, from os.scandir, which tells whether each entry is a directory 
+    without a separate system call (except for symbolic links). Size and modification time are found 
+    when first asked for (which on Windows also needs no extra system call)."""
+    
+    __slots__ = ["name", "path", "isDir", "dirEntry"]
+    
+    def __init__(self, dirEntry):
+        self.name = dirEntry.name
+        self.path = dirEntry.path
+        try:
+            self.isDir = dirEntry.is_dir()
+        except OSError:
+            self.isDir = False
+        self.dirEntry = dirEntry
+        
+    def stat(self):
+        """Result of stat for the entry (cached), or None if it has gone or can't be read"""
+        try:
+            return self.dirEntry.stat()
+        except OSError:
+            return None
+        
+    def size(self):
+        entryStat = self.stat()
+        return None if entryStat == None else entryStat.st_size
+    
+    def modificationTime(self):
+        entryStat = self.stat()
+        return None if entryStat == None else entryStat.st_mtime
+    
+    def resource(self):
+        """The Directory or File resource for this entry"""
+        return Directory(self.path) if self.isDir else File(self.path)
+    
+def listDirectory(path):
+    """List of DirectoryEntry's for the entries in a directory, sorted by name"""
+    with os.scandir(path) as dirEntries:
+        entries = [DirectoryEntry(dirEntry) for dirEntry in dirEntries]
+    entries.sort(key = lambda entry: entry.name)
+    return entries
+
+class DirectoryListing:
+    """A cached directory listing, with what is needed to tell if it is still current: the directory's 
+    modification time (when listed), the time it was listed, and its DirectoryWatcher version (if watched)"""
+    
+    def __init__(self, entries, modificationTimeNs, listedAt, version):
+        self.entries = entries
+        self.modificationTimeNs = modificationTimeNs
+        self.listedAt = listedAt
+        self.version = version
+        
+class DirectoryListingCache:
+    """Listings of recently listed directories, keyed by path. On Linux, directories are watched with 
+    inotify (see inotify_watcher.DirectoryWatcher), so a cached listing can be reused without any system 
+    call until the directory changes. Otherwise (or if 'useInotify' is False, which may be necessary for 
+    directories on network file systems changed by other machines) a listing is reused while the 
+    directory's modification time is unchanged (one stat), unless the directory was modified within
+    'racySeconds' of being listed (as a later change in the same clock tick wouldn't change the time). 
+    At most 'maxDirectories' listings are kept, with at most 'maxEntries' entries in total, the least 
+    recently used ones being discarded first."""
+    
+    racySeconds = 2.0
+    
+    def __init__(self, maxDirectories = 1000, maxEntries = 1000000, useInotify = True):
+        self.useInotify = useInotify
+        self.listings = LruCache(maxDirectories, maxEntries, lambda listing: len(listing.entries), 
+                                 onEvict = self.evicted)
+        self.lock = threading.Lock()
+        self.watcher = None
+        self.watcherProcessId = None
+        
+    def getWatcher(self):
+        """The DirectoryWatcher for this process (started when first needed), or None"""
+        if not self.useInotify:
+            return None
+        with self.lock:
+            if self.watcherProcessId != os.getpid():
+                self.watcherProcessId = os.getpid()
+                self.watcher = openDirectoryWatcher()
+            return self.watcher
+        
+    def evicted(self, path, listing):
+        if listing.version != None and self.watcher != None:
+            self.watcher.unwatch(path)
+            
+    def getEntries(self, path):
+        """Entries in a directory (a list of DirectoryEntry's, sorted by name, which must not be changed)"""
+        watcher = self.getWatcher()
+        listing = self.listings.get(path)
+        if listing != None:
+            if listing.version != None and watcher != None and watcher.version(path) == listing.version:
+                return listing.entries
+            dirStat = os.stat(path)
+            if (dirStat.st_mtime_ns == listing.modificationTimeNs and 
+                    listing.listedAt - dirStat.st_mtime > self.racySeconds):
+                return listing.entries
+        version = watcher.watch(path) if watcher != None else None # (before listing, so no change is missed)
+        dirStat = os.stat(path)
+        listedAt = time.time()
+        entries = listDirectory(path)
+        self.listings.put(path, DirectoryListing(entries, dirStat.st_mtime_ns, listedAt, version))
+        return entries
+    
+    def stats(self):
+        return self.listings.stats()
+    
+"""Listings of directories, shared by all Directory resources"""
+directoryListingCache = DirectoryListingCache()
+
+"""Threads listing directories ahead of a TreeTraversal"""
+treeListingExecutor = concurrent.futures.ThreadPoolExecutor(8)
+
+class TreeTraversal:
+    """Traversal of a directory tree for a tree view, written out in order (files then sub-directories,
+    each sorted by name), while sub-directories yet to be written out are listed concurrently by 
+    treeListingExecutor, up to 'maxPrefetch' listings ahead. The traversal stops after 'maxEntries' entries, 
+    or after 'maxSeconds' seconds, and sub-directories deeper than the view's depth (if given) are not listed. 
+    Each directory not completely shown is marked with a link to continue from that directory."""
+    
+    maxEntries = 5000
+    maxSeconds = 10.0
+    maxPrefetch = 32
+    
+    def __init__(self, view):
+        self.view = view
+        self.entryCount = 0
+        self.stopped = False
+        self.timedOut = False
+        self.prefetched = {}
+        
+    def prefetch(self, path):
+        """Start listing a directory, unless too many listings are already waiting"""
+        if len(self.prefetched) < self.maxPrefetch and path not in self.prefetched:
+            self.prefetched[path] = treeListingExecutor.submit(directoryListingCache.getEntries, path)
+            
+    def getEntries(self, path):
+        """Entries of a directory (as prefetched, if it was), or None if the time ran out first"""
+        future = self.prefetched.pop(path, None)
+        if future == None:
+            return directoryListingCache.getEntries(path)
+        try:
+            return future.result(timeout = max(self.deadline - time.time(), 0))
+        except concurrent.futures.TimeoutError:
+            self.timedOut = True
+            return None
+        
+    def limitReached(self):
+        if not self.stopped:
+            if self.entryCount >= self.maxEntries:
+                self.stopped = True
+            elif time.time() > self.deadline:
+                self.stopped = self.timedOut = True
+        return self.stopped
+    
+    def continueLink(self, directory):
+        return tag.A("continue from %s" % h(directory.path), href = directory.url(view = self.view))
+        
+    def html(self, directory):
+        """Yield HTML for the tree below a directory (walked with an explicit stack of open directories, 
+        rather than by recursion, so that each element is yielded directly however deep the tree is)"""
+        self.deadline = time.time() + self.maxSeconds
+        openDirectories = [] # (directory, iterator of remaining entries, depth, whether to list sub-directories)
+        try:
+            for element in self.startDirectory(directory, 1, openDirectories):
+                yield element
+            while len(openDirectories) > 0:
+                directory, entries, depth, listSubdirs = openDirectories[-1]
+                entry = next(entries, None)
+                if entry != None and self.limitReached():
+                    yield tag.LI("... ", self.continueLink(directory))
+                    entry = None
+                if entry == None:
+                    openDirectories.pop()
+                    yield tag.UL().end()
+                    if len(openDirectories) > 0:
+                        yield tag.LI().end()
+                    continue
+                self.entryCount += 1
+                if not entry.isDir:
+                    yield tag.LI(tag.A(h(entry.name), href = entry.resource().url()))
+                    continue
+                subdir = entry.resource()
+                yield tag.LI().start()
+                yield tag.A(h(entry.name), href = subdir.url(view = self.view))
+                openCount = len(openDirectories)
+                if listSubdirs:
+                    for element in self.startDirectory(subdir, depth+1, openDirectories):
+                        yield element
+                else:
+                    yield " ..."
+                if len(openDirectories) == openCount:
+                    yield tag.LI().end()
+        finally:
+            for future in self.prefetched.values():
+                future.cancel()
+            self.prefetched.clear()
+        if self.timedOut:
+            markPageUncacheable() # (where it stopped depends on how long things took)
+            
+    def startDirectory(self, directory, depth, openDirectories):
+        """Return HTML starting the list of a directory's entries, and add the directory to 
+        'openDirectories' (or, if it can't be listed in time, HTML saying so)"""
+        try:
+            recordPageSource(directory, View("list"))
+            entries = self.getEntries(directory.path)
+        except OSError as error:
+            markPageUncacheable()
+            return [" (%s)" % h(str(error))]
+        if entries == None:
+            self.stopped = True
+            return [" ... ", self.continueLink(directory)]
+        listSubdirs = self.view.depth == None or depth < self.view.depth
+        fileEntries = [entry for entry in entries if not entry.isDir]
+        dirEntries = [entry for entry in entries if entry.isDir]
+        if listSubdirs:
+            for entry in dirEntries:
+                self.prefetch(entry.path)
+        openDirectories.append((directory, iter(fileEntries + dirEntries), depth, listSubdirs))
+        return [tag.UL().start()]
         
 @resourceTypeNameInModule("dir", aptrowModule)
 class Directory(Resource):
@@ -37,6 +261,19 @@ class Directory(Resource):
         elif not os.path.isdir(self.path):
             raise NoSuchObjectException("Path %r is not a directory" % self.path)
         
+    def validator(self, view):
+        """The list view only changes when entries are added, removed or renamed, which changes the
+        directory's modification time (but a tree view also depends on sub-directories, and a detailed
+        list view on the sizes and times of every entry)."""
+        if view.type == "list" and not view.params.get("details"):
+            return fileValidator(self.path)
+        else:
+            return None
+        
+    def recordsPageSources(self, view):
+        """A tree view records the directories it lists (see showFilesAndDirectoriesAsTree)"""
+        return view.type == "tree"
+        
     def isDir(self):
         """Yes this resource represents a directory (as opposed to a file)"""
         return True
@@ -64,7 +301,8 @@ class Directory(Resource):
     
     def html(self, view):
         """HTML content for directory: show lists of files and sub-directories."""
-        yield tag.P("Views ", *self.listAndTreeViewLinks(view))
+        yield tag.P("Views ", *(self.listAndTreeViewLinks(view) + 
+                                [" ", self.viewLink(View("list", {"details": "yes"}), "details", view)]))
         parentDir = self.parent()
         if parentDir:
             yield tag.P("Parent: ", tag.A(h(parentDir.path), href = parentDir.url(view = view)))
@@ -85,11 +323,12 @@ class Directory(Resource):
         """Search for a file containing pattern in name."""
         return SearchForFileInDirectory(self, pattern)
         
-    def getDirAndFileEntries(self):
-        entryNames = os.listdir(self.path)
-        entries = [(name, self.fileEntry(name)) for name in entryNames]
-        dirEntries = [(name, entry) for (name, entry) in entries if entry.isDir()]
-        fileEntries = [(name, entry) for (name, entry) in entries if not entry.isDir()]
+    def getDirAndFileEntries(self, fresh = False):
+        """Lists of DirectoryEntry's for sub-directories and files, each sorted by name (from 
+        directoryListingCache, unless 'fresh' is True, for when the entries' stat results are needed)"""
+        entries = listDirectory(self.path) if fresh else directoryListingCache.getEntries(self.path)
+        dirEntries = [entry for entry in entries if entry.isDir]
+        fileEntries = [entry for entry in entries if not entry.isDir]
         return (dirEntries, fileEntries)
     
     @byViewMethod
@@ -97,42 +336,42 @@ class Directory(Resource):
         pass
     
     @byView("tree", showFilesAndDirectories)
-    def showFilesAndDirectoriesAsTree(self, view, depth = None):
-        if depth == None:
-            depth = view.depth
-        dirEntries, fileEntries = self.getDirAndFileEntries()
-        yield tag.UL().start()
-        for name, entry in fileEntries:
-            print (entry.heading())
-            yield tag.LI(tag.A(h(name), href = entry.url()))
-        for name, entry in dirEntries:
-            print (entry.heading())
-            yield tag.LI().start()
-            yield tag.A(h(name), href = entry.url(view = view))
-            if depth == None or depth > 1:
-                for element in entry.showFilesAndDirectoriesAsTree(view, view.depthLessOne()): 
-                    yield element
-            else:
-                yield " ..."
-            yield tag.LI().end()
-        yield tag.UL().end()
+    def showFilesAndDirectoriesAsTree(self, view):
+        """Show files and sub-directories as a tree, down to the view's depth (if given), and 
+        limited in size and time (see TreeTraversal)"""
+        return TreeTraversal(view).html(self)
         
     @byView("list", showFilesAndDirectories)
     def showFilesAndDirectoriesAsList(self, view):
-        """ Show each of files and sub-directories as a list of links to those resources."""
-        dirEntries, fileEntries = self.getDirAndFileEntries()
+        """ Show each of files and sub-directories as a list of links to those resources
+        (with sizes and modification times if the view has the 'details' parameter)."""
+        details = view.params.get("details")
+        dirEntries, fileEntries = self.getDirAndFileEntries(fresh = bool(details))
         if len(dirEntries) > 0:
             yield tag.H3("Sub-directories")
             yield tag.UL().start()
-            for name, entry in dirEntries:
-                yield tag.LI(tag.A(h(name), href = entry.url(view = view)))
+            for entry in dirEntries:
+                yield tag.LI(tag.A(h(entry.name), href = entry.resource().url(view = view)), 
+                             self.entryDetails(entry) if details else "")
             yield tag.UL().end()
         if len(fileEntries) > 0:
             yield tag.H3("Files")
             yield tag.UL().start()
-            for name, entry in fileEntries:
-                yield tag.LI(tag.A(h(name), href = entry.url()))
+            for entry in fileEntries:
+                yield tag.LI(tag.A(h(entry.name), href = entry.resource().url()), 
+                             self.entryDetails(entry) if details else "")
             yield tag.UL().end()
+            
+    def entryDetails(self, entry):
+        """Size (of a file) and modification time of a directory entry"""
+        modificationTime = entry.modificationTime()
+        if modificationTime == None:
+            return ""
+        modified = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(modificationTime))
+        if entry.isDir:
+            return " (modified %s)" % modified
+        else:
+            return " (%s bytes, modified %s)" % (entry.size(), modified)
     
 @resourceTypeNameInModule("file", aptrowModule)
 class File(Resource):
@@ -160,6 +399,9 @@ class File(Resource):
         elif not os.path.isfile(self.path):
             raise NoSuchObjectException("Path %r is not a file" % self.path)
         
+    def validator(self, view):
+        return fileValidator(self.path)
+        
     def extension(self):
         lastDotPos = self.path.rfind(".")
         if lastDotPos == -1:
@@ -210,13 +452,14 @@ class SearchForFileInDirectory(Resource):
         
     def filesContainingPattern(self, directory, relativePath = None):
         dirEntries, fileEntries = directory.getDirAndFileEntries()
-        for name, fileResource in fileEntries:
-            if name.find(self.pattern) != -1:
-                fileRelativePath = name if relativePath == None else os.path.join(relativePath, name)
-                yield fileResource, fileRelativePath
-        for name, dirResource in dirEntries:
-            dirRelativePath = name if relativePath == None else os.path.join(relativePath, name)
-            if name.find(self.pattern) != -1:
+        for entry in fileEntries:
+            if entry.name.find(self.pattern) != -1:
+                fileRelativePath = entry.name if relativePath == None else os.path.join(relativePath, entry.name)
+                yield entry.resource(), fileRelativePath
+        for entry in dirEntries:
+            dirResource = entry.resource()
+            dirRelativePath = entry.name if relativePath == None else os.path.join(relativePath, entry.name)
+            if entry.name.find(self.pattern) != -1:
                 yield dirResource, dirRelativePath
             for resourceAndPath in self.filesContainingPattern(dirResource, dirRelativePath):
                 yield resourceAndPath
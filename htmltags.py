@@ -61,7 +61,7 @@ def tagFunction(tagName):
 """List of HTML tags (incomplete at the moment)"""
 htmlTagNames = ["h1", "h2", "h3", "h4", "h5", "h6", "a", "p", "b", "ul", "li", "small", "br", 
                 "table", "thead", "tbody", "tr", "tr", "td", 
-                "form", "input", "submit"]
+                "form", "input", "submit", "textarea", "pre"]
 
 """Define tag functions for names in htmlTagNames (function names 
 are capitalized, e.g. UL for <ul> tag)."""
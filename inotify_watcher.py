@@ -0,0 +1,133 @@
+""" Copyright 2009 Philip Dorrell http://www.1729.com/ (email: http://www.1729.com/email.html)
+
+  This file is part of Aptrow ("Advance Programming Technology Read-Only Webification": http://www.1729.com/aptrow/)
+
+  Aptrow is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+  as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+  Aptrow is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+  of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License along with Aptrow (as license-gplv3.txt).
+  If not, see <http://www.gnu.org/licenses/>."""
+
+"""Watching directories for changes with Linux inotify (through ctypes, as the standard library 
+has no interface to it)"""
+
+import ctypes
+import ctypes.util
+import itertools
+import os
+import struct
+import sys
+import threading
+
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_CLOEXEC = 0o2000000
+
+"""Events which change the list of entries in a watched directory (or remove the directory itself)"""
+directoryChangesMask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF
+
+eventHeader = struct.Struct("iIII") # wd, mask, cookie, len (followed by name)
+
+class DirectoryWatcher:
+    """Watches directories with inotify, giving each watched directory a version number which changes
+    whenever entries are added to, removed from or renamed in the directory, so that a listing made 
+    after 'watch' returned a version is known to be current for as long as 'version' returns the same 
+    version. Events are read by a background thread. At most 'maxWatches' directories are watched.
+    (Note that inotify doesn't see changes made by other machines to directories on network file systems.)"""
+    
+    maxWatches = 4096
+    
+    def __init__(self, libc):
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            errorNumber = ctypes.get_errno()
+            raise OSError(errorNumber, os.strerror(errorNumber))
+        self.lock = threading.Lock()
+        self.versionCounter = itertools.count(1)
+        self.watchDescriptors = {}
+        self.pathsByWatchDescriptor = {}
+        self.versions = {}
+        thread = threading.Thread(target = self.readEvents, name = "DirectoryWatcher")
+        thread.daemon = True
+        thread.start()
+        
+    def version(self, path):
+        """Current version of a watched directory (None if it isn't being watched)"""
+        with self.lock:
+            return self.versions.get(path)
+        
+    def watch(self, path):
+        """Start watching a directory (if not already watched), and return its current version 
+        (or None if it can't be watched)"""
+        with self.lock:
+            if path in self.versions:
+                return self.versions[path]
+            if len(self.versions) >= self.maxWatches:
+                return None
+        watchDescriptor = self.libc.inotify_add_watch(self.fd, os.fsencode(path), directoryChangesMask | IN_ONLYDIR)
+        if watchDescriptor < 0:
+            return None
+        with self.lock:
+            self.watchDescriptors[path] = watchDescriptor
+            self.pathsByWatchDescriptor.setdefault(watchDescriptor, set()).add(path)
+            return self.versions.setdefault(path, next(self.versionCounter))
+        
+    def unwatch(self, path):
+        """Stop watching a directory"""
+        with self.lock:
+            watchDescriptor = self.watchDescriptors.pop(path, None)
+            self.versions.pop(path, None)
+            if watchDescriptor == None:
+                return
+            paths = self.pathsByWatchDescriptor.get(watchDescriptor, set())
+            paths.discard(path)
+            if len(paths) > 0: # (the same directory is also watched by another path)
+                return
+            del self.pathsByWatchDescriptor[watchDescriptor]
+        self.libc.inotify_rm_watch(self.fd, watchDescriptor)
+        
+    def readEvents(self):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except InterruptedError:
+                continue
+            except OSError:
+                return
+            offset = 0
+            with self.lock:
+                while offset + eventHeader.size <= len(data):
+                    watchDescriptor, mask, cookie, nameLength = eventHeader.unpack_from(data, offset)
+                    offset += eventHeader.size + nameLength
+                    if mask & IN_Q_OVERFLOW: # events were lost, so every directory might have changed
+                        for path in self.versions:
+                            self.versions[path] = next(self.versionCounter)
+                    elif mask & IN_IGNORED: # watch removed (the directory has gone)
+                        for path in self.pathsByWatchDescriptor.pop(watchDescriptor, set()):
+                            self.versions.pop(path, None)
+                            self.watchDescriptors.pop(path, None)
+                    else:
+                        for path in self.pathsByWatchDescriptor.get(watchDescriptor, set()):
+                            self.versions[path] = next(self.versionCounter)
+                            
+def openDirectoryWatcher():
+    """Return a new DirectoryWatcher, or None if inotify isn't available (i.e. not on Linux)"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno = True)
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return DirectoryWatcher(libc)
+    except (OSError, AttributeError):
+        return None
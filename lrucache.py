@@ -0,0 +1,113 @@
+""" Copyright 2009 Philip Dorrell http://www.1729.com/ (email: http://www.1729.com/email.html)
+
+  This file is part of Aptrow ("Advance Programming Technology Read-Only Webification": http://www.1729.com/aptrow/)
+
+  Aptrow is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+  as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+  Aptrow is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+  of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License along with Aptrow (as license-gplv3.txt).
+  If not, see <http://www.gnu.org/licenses/>."""
+
+"""A thread-safe bounded cache with least-recently-used eviction"""
+
+import collections
+import threading
+
+class LruCache:
+    """A mapping from keys to values holding at most 'maxEntries' entries. When full, adding an
+    entry discards the least recently used one. If 'maxSize' is given, entries are also discarded to keep
+    the total size of the values (as given by 'sizeOf') within it. If given, onEvict(key, value) is called
+    (with the cache locked) for each entry discarded to make room. Counts hits and misses. Safe to share between threads
+    (values are created outside the lock, so two threads may occasionally both create a missing value,
+    in which case the first one stored wins)."""
+
+    def __init__(self, maxEntries, maxSize = None, sizeOf = len, onEvict = None):
+        self.maxEntries = maxEntries
+        self.onEvict = onEvict
+        self.maxSize = maxSize
+        self.sizeOf = sizeOf
+        self.totalSize = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default = None):
+        """Return the cached value for key (counting a hit or a miss), or default if not cached"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            else:
+                self.misses += 1
+                return default
+
+    def peek(self, key, default = None):
+        """Return the cached value for key, or default, without counting a lookup or making it more recently used"""
+        with self.lock:
+            return self.entries.get(key, default)
+        
+    def put(self, key, value):
+        """Store a value (replacing any existing value for key), evicting old entries as necessary"""
+        with self.lock:
+            self.removeEntry(key)
+            self.entries[key] = value
+            if self.maxSize != None:
+                self.totalSize += self.sizeOf(value)
+            while len(self.entries) > self.maxEntries or (self.maxSize != None and self.totalSize > self.maxSize 
+                                                          and len(self.entries) > 1):
+                oldKey = next(iter(self.entries))
+                oldValue = self.entries[oldKey]
+                self.removeEntry(oldKey)
+                self.evictions += 1
+                if self.onEvict != None:
+                    self.onEvict(oldKey, oldValue)
+                
+    def removeEntry(self, key):
+        """Remove an entry, if present (with the lock held)"""
+        if key in self.entries:
+            value = self.entries.pop(key)
+            if self.maxSize != None:
+                self.totalSize -= self.sizeOf(value)
+
+    def getOrCreate(self, key, create):
+        """Return the cached value for key, or call create() to make it, and cache that"""
+        missing = self.entries # (never a value)
+        value = self.get(key, missing)
+        if value is missing:
+            value = create()
+            with self.lock:
+                if key in self.entries:
+                    return self.entries[key]
+            self.put(key, value)
+        return value
+
+    def remove(self, key):
+        with self.lock:
+            self.removeEntry(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.totalSize = 0
+
+    def stats(self):
+        """Return a dict of statistics about this cache"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries),
+                    "maxEntries": self.maxEntries,
+                    "totalSize": self.totalSize,
+                    "maxSize": self.maxSize,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hitRatio": float(self.hits) / lookups if lookups > 0 else 0.0,
+                    "evictions": self.evictions}
@@ -14,9 +14,513 @@
 from aptrow import *
 
 import sqlite3
+import urllib.request
+import ast
+import concurrent.futures
+import csv
+import json
+from lrucache import LruCache
 
 aptrowModule = ResourceModule()
 
+def quoteIdentifier(name):
+    """Quote a table or column name for use in SQL"""
+    return "\"%s\"" % name.replace("\"", "\"\"")
+
+def formatOther(value):
+    return h(str(value))
+
+"""Formatters for values (of the types returned by sqlite3) shown in HTML table cells. 
+(Numbers and None don't need escaping.)"""
+cellFormatters = {int: str, float: str, str: h, type(None): str}
+
+def formatCell(value):
+    return cellFormatters.get(type(value), formatOther)(value)
+
+def htmlTableRows(rows, skipColumns = 0):
+    """HTML for table rows, with a cell for each value (after the first 'skipColumns' of each row). 
+    Values are formatted a column at a time, with a formatter specialised for the type of the 
+    column's values if they are all of one type, and then interpolated into a template for the whole row.
+    (Produces the same HTML as tag.TR([tag.TD(h(str(value))) for value in row]) for each row.)"""
+    if len(rows) == 0:
+        return ""
+    columns = list(zip(*rows))[skipColumns:]
+    formattedColumns = []
+    for column in columns:
+        columnTypes = set(map(type, column))
+        formatter = cellFormatters.get(columnTypes.pop(), formatOther) if len(columnTypes) == 1 else formatCell
+        formattedColumns.append(map(formatter, column))
+    rowTemplate = "<tr>%s</tr>" % ("<td>%s</td>" * len(columns))
+    return "".join([rowTemplate % row for row in zip(*formattedColumns)])
+
+def quoteAttribute(value):
+    """Escape a value for use as an HTML attribute value"""
+    return h(value).replace("\"", "&quot;")
+
+"""Authorizer actions allowed when running a query (see SqliteQuery): only reading"""
+readOnlyActions = set([sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, 
+                       getattr(sqlite3, "SQLITE_RECURSIVE", 33)])
+
+def readOnlyAuthorizer(action, arg1, arg2, databaseName, triggerOrView):
+    return sqlite3.SQLITE_OK if action in readOnlyActions else sqlite3.SQLITE_DENY
+
+def blobsAsHex(rows):
+    """Rows with any blob values replaced by hexadecimal strings (for text export formats)"""
+    columns = list(zip(*rows))
+    blobColumns = [i for i, column in enumerate(columns) if bytes in set(map(type, column))]
+    if len(blobColumns) == 0:
+        return rows
+    for i in blobColumns:
+        columns[i] = [value.hex() if type(value) is bytes else value for value in columns[i]]
+    return list(zip(*columns))
+
+class CsvExporter:
+    """Writes rows as CSV (with a header row of column names), encoded as UTF-8"""
+    
+    contentType = "text/csv; charset=utf-8"
+    
+    def __init__(self, columnNames):
+        self.columnNames = columnNames
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        
+    def header(self):
+        self.writer.writerow(self.columnNames)
+        return self.flush()
+    
+    def chunk(self, rows):
+        self.writer.writerows(blobsAsHex(rows))
+        return self.flush()
+    
+    def flush(self):
+        """Return (and clear) what has been written to the buffer"""
+        text = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return text.encode("utf-8")
+    
+class NdjsonExporter:
+    """Writes rows as newline-delimited JSON (an object for each row, keyed by column name), encoded as UTF-8"""
+    
+    contentType = "application/x-ndjson"
+    
+    def __init__(self, columnNames):
+        self.columnNames = columnNames
+        self.encoder = json.JSONEncoder(ensure_ascii = False, check_circular = False)
+        
+    def header(self):
+        return b""
+    
+    def chunk(self, rows):
+        encode = self.encoder.encode
+        columnNames = self.columnNames
+        return "".join([encode(dict(zip(columnNames, row))) + "\n" for row in blobsAsHex(rows)]).encode("utf-8")
+    
+def exportRows(app, cursor, exporterClass, fetchRows):
+    """Start the response, and stream the rows of a cursor in an export format, a batch of rows (from 
+    fetchRows()) at a time, so that an export of any size only needs memory for one batch"""
+    exporter = exporterClass([desc[0] for desc in cursor.description or []])
+    app.start('200 OK', [('Content-Type', exporter.contentType)])
+    yield exporter.header()
+    rows = fetchRows()
+    while len(rows) > 0:
+        yield exporter.chunk(rows)
+        rows = fetchRows()
+        
+def databaseUri(path, immutable = False):
+    """URI for opening a database file read-only (and, if immutable, telling sqlite that nothing 
+    else can change it, so that it doesn't need to do any locking)"""
+    return "file:%s?mode=ro%s" % (urllib.request.pathname2url(os.path.abspath(path)), 
+                                  "&immutable=1" if immutable else "")
+
+class DataVersionMonitor:
+    """Long-lived connections (one per database file) for reading 'PRAGMA data_version', which 
+    changes whenever another connection commits a change to the database (including changes 
+    which only affect the write-ahead log, and so don't change the database file itself). 
+    Connections to at most 'maxDatabases' databases are kept open (the least recently used 
+    ones being closed first). Each connection is kept with the identity (device and inode) of the file 
+    it was opened on, so that it is replaced if the file is replaced (for example by renaming another 
+    file over it), as it would otherwise go on reading the old file."""
+    
+    def __init__(self, maxDatabases = 64):
+        self.lock = threading.Lock()
+        self.connections = LruCache(maxDatabases, onEvict = self.evicted)
+        
+    def evicted(self, path, identityAndConnection):
+        identityAndConnection[1].close()
+        
+    def dataVersion(self, path):
+        """The data version of a database file, or None if it can't be read as a database"""
+        fileStat = os.stat(path)
+        identity = (fileStat.st_dev, fileStat.st_ino)
+        with self.lock:
+            identityAndConnection = self.connections.get(path)
+            connection = None
+            if identityAndConnection != None:
+                if identityAndConnection[0] == identity:
+                    connection = identityAndConnection[1]
+                else:
+                    self.connections.remove(path)
+                    identityAndConnection[1].close()
+            try:
+                if connection == None:
+                    connection = sqlite3.connect(databaseUri(path), uri = True, check_same_thread = False)
+                    self.connections.put(path, (identity, connection))
+                return connection.execute("PRAGMA data_version").fetchone()[0]
+            except sqlite3.Error:
+                if connection != None:
+                    self.connections.remove(path)
+                    connection.close()
+                return None
+        
+dataVersionMonitor = DataVersionMonitor()
+
+def openDatabaseFile(path, immutable = False):
+    """Open a read-only connection to a database file (usable by any thread, see SqliteConnectionPool)"""
+    return sqlite3.connect(databaseUri(path, immutable), uri = True, check_same_thread = False)
+
+def openDatabaseImage(image):
+    """Open a read-only in-memory connection to a copy of a database image (see DatabaseImageCache)"""
+    connection = sqlite3.connect(":memory:", check_same_thread = False)
+    connection.deserialize(image)
+    connection.execute("PRAGMA query_only = ON")
+    return connection
+
+class DatabaseImageCache:
+    """Images (complete contents) of databases which aren't files on the local file system (such as 
+    database files in zip files), keyed by URL and validator token, so that they can be loaded straight 
+    into in-memory connections (see openDatabaseImage), instead of being copied to files. 
+    Only databases of at most 'maxImageSize' bytes are loaded (set it to 0 to always copy databases to 
+    files); the least recently used images are discarded to keep the total within 'maxBytes' bytes. 
+    (Each in-memory connection has its own copy of the image, as sqlite needs a writable copy.)"""
+    
+    def __init__(self, maxImageSize = 32*1024*1024, maxBytes = 256*1024*1024):
+        self.maxImageSize = maxImageSize
+        self.images = LruCache(1000, maxBytes, lambda image: len(image) if image else 0)
+        
+    def getImage(self, fileResource):
+        """Return the key and image of a database, or None if it can't be loaded into memory 
+        (because it's too big, or doesn't have a validator, or this version of sqlite3 can't deserialize)"""
+        if self.maxImageSize <= 0 or not hasattr(sqlite3.Connection, "deserialize"):
+            return None
+        validator = fileResource.validator(None)
+        if validator == None:
+            return None
+        key = (fileResource.url(), validator.token)
+        image = self.images.get(key)
+        if image == None:
+            image = self.readImage(fileResource)
+            self.images.put(key, image if image != None else False) # (False: remember it's too big)
+        return (key, image) if image else None
+        
+    def readImage(self, fileResource):
+        """Read the database (or return None if it's bigger than maxImageSize)"""
+        chunks = []
+        size = 0
+        with fileResource.openBinaryFile() as binaryFile:
+            chunk = binaryFile.read(1024*1024)
+            while chunk:
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > self.maxImageSize:
+                    return None
+                chunk = binaryFile.read(1024*1024)
+        image = b"".join(chunks)
+        if image[18:20] == b"\x02\x02": # write-ahead log mode, which an in-memory database can't use
+            image = image[:18] + b"\x01\x01" + image[20:]
+        return image
+    
+"""Images of small and medium sized databases in zip files (and other file-like resources)"""
+databaseImageCache = DatabaseImageCache()
+
+class PooledSqliteConnection:
+    """A connection checked out of a SqliteConnectionPool, which is returned to the pool 
+    when closed (or at the end of a 'with' block)"""
+    
+    def __init__(self, pool, key, connection):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        
+    def __enter__(self):
+        return self.connection
+    
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        
+    def close(self):
+        if self.connection != None:
+            self.pool.checkin(self.key, self.connection)
+            self.connection = None
+    
+class ConnectionTimeoutException(MessageException):
+    """Thrown when no connection to a database becomes free within a SqliteConnectionPool's 'checkoutTimeout'"""
+    def __init__(self, key, timeout):
+        self.message = "No connection to database %r became free within %s seconds" % (key, timeout)
+    
+class SqliteConnectionPool:
+    """Pool of read-only connections to database files, so that a connection (and the schema 
+    it has already parsed, and its page cache) is reused by successive requests. 
+    A connection is used by one checkout at a time, but possibly by different threads in turn 
+    (an asyncio page is produced by whichever executor thread is free), so connections are opened 
+    with check_same_thread = False, and an idle connection last used by the checking-out thread
+    is preferred. At most 'maxOpenPerDatabase' connections to each database are open at once (checked out
+    or idle): a checkout which would need another one waits for one to be checked in, for up to 
+    'checkoutTimeout' seconds (and then fails with ConnectionTimeoutException). At most 'maxIdlePerDatabase'
+    idle connections are kept for each database, and at most 'maxIdle' in total (least recently used 
+    databases' connections being closed first); connections idle for more than 'idleTimeout' seconds are closed."""
+    
+    def __init__(self, maxOpenPerDatabase = 8, maxIdlePerDatabase = 4, maxIdle = 32, idleTimeout = 60, 
+                 checkoutTimeout = 30):
+        self.maxOpenPerDatabase = maxOpenPerDatabase
+        self.maxIdlePerDatabase = maxIdlePerDatabase
+        self.maxIdle = maxIdle
+        self.idleTimeout = idleTimeout
+        self.checkoutTimeout = checkoutTimeout
+        self.lock = threading.Lock()
+        self.connectionFree = threading.Condition(self.lock)
+        self.idleConnections = collections.OrderedDict()
+        self.idleCount = 0
+        self.openCounts = {}
+        self.opened = 0
+        self.reused = 0
+        self.closed = 0
+        self.waits = 0
+        self.timeouts = 0
+        
+    def checkout(self, key, openConnection):
+        """Return a PooledSqliteConnection to the database identified by 'key' (to be closed after use), 
+        calling openConnection() to open a new connection if there isn't an idle one (waiting for one 
+        to be checked in if the database already has 'maxOpenPerDatabase' connections)."""
+        threadId = threading.get_ident()
+        connection = None
+        timedOut = False
+        deadline = time.time() + self.checkoutTimeout
+        with self.lock:
+            expiredConnections = self.removeExpired(time.time())
+            while True:
+                idleConnections = self.idleConnections.get(key)
+                if idleConnections:
+                    index = len(idleConnections) - 1
+                    for i, (idleConnection, lastThreadId, lastUsed) in enumerate(idleConnections):
+                        if lastThreadId == threadId:
+                            index = i
+                    connection = idleConnections.pop(index)[0]
+                    if len(idleConnections) == 0:
+                        del self.idleConnections[key]
+                    self.idleCount -= 1
+                    self.reused += 1
+                    break
+                if self.openCounts.get(key, 0) < self.maxOpenPerDatabase:
+                    self.openCounts[key] = self.openCounts.get(key, 0) + 1 # (reserved for the new connection)
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    timedOut = True
+                    break
+                self.waits += 1
+                self.connectionFree.wait(remaining)
+        self.closeConnections(expiredConnections)
+        if timedOut:
+            raise ConnectionTimeoutException(key, self.checkoutTimeout)
+        if connection == None:
+            try:
+                connection = openConnection()
+            except BaseException:
+                with self.lock:
+                    self.connectionClosed(key)
+                raise
+            with self.lock:
+                self.opened += 1
+        return PooledSqliteConnection(self, key, connection)
+    
+    def checkin(self, key, connection):
+        if connection.in_transaction:
+            connection.rollback()
+        closingConnections = []
+        with self.lock:
+            idleConnections = self.idleConnections.setdefault(key, [])
+            self.idleConnections.move_to_end(key)
+            if len(idleConnections) >= self.maxIdlePerDatabase:
+                closingConnections.append(connection)
+                self.connectionClosed(key)
+            else:
+                idleConnections.append((connection, threading.get_ident(), time.time()))
+                self.idleCount += 1
+                self.connectionFree.notify_all()
+            while self.idleCount > self.maxIdle:
+                oldestKey = next(iter(self.idleConnections))
+                oldestConnections = self.idleConnections[oldestKey]
+                closingConnections.append(oldestConnections.pop(0)[0])
+                self.connectionClosed(oldestKey)
+                if len(oldestConnections) == 0:
+                    del self.idleConnections[oldestKey]
+                self.idleCount -= 1
+            if len(idleConnections) == 0:
+                del self.idleConnections[key]
+        self.closeConnections(closingConnections)
+        
+    def connectionClosed(self, key):
+        """Count one less open connection to a database, and wake any checkouts waiting for it 
+        (called with lock held)"""
+        self.openCounts[key] -= 1
+        if self.openCounts[key] == 0:
+            del self.openCounts[key]
+        self.connectionFree.notify_all()
+        
+    def removeExpired(self, now):
+        """Remove connections idle for too long (called with lock held), returning them to be closed"""
+        expiredConnections = []
+        for key in list(self.idleConnections.keys()):
+            idleConnections = self.idleConnections[key]
+            keyExpiredConnections = [connection for connection, threadId, lastUsed in idleConnections 
+                                     if now - lastUsed > self.idleTimeout]
+            for connection in keyExpiredConnections:
+                self.connectionClosed(key)
+            expiredConnections += keyExpiredConnections
+            idleConnections[:] = [entry for entry in idleConnections if now - entry[2] <= self.idleTimeout]
+            if len(idleConnections) == 0:
+                del self.idleConnections[key]
+        self.idleCount -= len(expiredConnections)
+        return expiredConnections
+    
+    def closeConnections(self, connections):
+        for connection in connections:
+            connection.close()
+        with self.lock:
+            self.closed += len(connections)
+            
+    def stats(self):
+        with self.lock:
+            return {"open": sum(self.openCounts.values()), "idle": self.idleCount, 
+                    "databases": len(self.idleConnections), "opened": self.opened, "reused": self.reused, 
+                    "closed": self.closed, "waits": self.waits, "timeouts": self.timeouts}
+    
+"""Pool of connections shared by all SqliteDatabase and SqliteTable resources"""
+sqliteConnectionPool = SqliteConnectionPool()
+
+class DatabaseMetadata:
+    """Metadata about one version of a database (cached in databaseMetadataCache): its tables, and, 
+    computed when first needed, each table's columns, indexes, key columns and row counts. 
+    An approximate row count (from sqlite_stat1, or the maximum rowid) is available at once; exact
+    counts (which need a scan of each table) are computed in the background by countExecutor."""
+    
+    def __init__(self, database):
+        self.database = database
+        self.lock = threading.Lock()
+        columnNames, rows = self.query("SELECT name FROM sqlite_master WHERE type = 'table'")
+        self.tables = [row[0] for row in rows]
+        self.tableInfos = {}
+        self.indexLists = {}
+        self.keyColumnLists = {}
+        self.approximateCounts = {}
+        self.exactCounts = {}
+        self.countingStarted = False
+        
+    def query(self, query, args = ()):
+        """Column names and all rows of the results of a query"""
+        with self.database.connect() as connection:
+            cursor = connection.execute(query, args)
+            try:
+                return [desc[0] for desc in cursor.description], cursor.fetchall()
+            finally:
+                cursor.close()
+                
+    def cached(self, values, name, compute):
+        """Value for a table from one of the dicts of values, computing it if necessary"""
+        with self.lock:
+            if name in values:
+                return values[name]
+        value = compute()
+        with self.lock:
+            return values.setdefault(name, value)
+        
+    def tableInfo(self, name):
+        """Column names and rows of 'pragma table_info' for a table"""
+        return self.cached(self.tableInfos, name, 
+                           lambda: self.query("pragma table_info(%s)" % quoteIdentifier(name)))
+    
+    def indexList(self, name):
+        """Column names and rows of 'pragma index_list' for a table"""
+        return self.cached(self.indexLists, name, 
+                           lambda: self.query("pragma index_list(%s)" % quoteIdentifier(name)))
+    
+    def keyColumns(self, name):
+        """Columns which identify each row of a table, in order, for keyset pagination: the rowid (by 
+        whichever of its aliases isn't also the name of an actual column), or else (for a 'WITHOUT ROWID' 
+        table) the primary key columns"""
+        return self.cached(self.keyColumnLists, name, lambda: self.findKeyColumns(name))
+    
+    def findKeyColumns(self, name):
+        tableInfoColumnNames, tableInfo = self.tableInfo(name)
+        columnNames = set([row[1].lower() for row in tableInfo])
+        for rowidAlias in ["rowid", "_rowid_", "oid"]:
+            if rowidAlias not in columnNames:
+                try:
+                    self.query("SELECT %s FROM %s LIMIT 0" % (rowidAlias, quoteIdentifier(name)))
+                    return [rowidAlias]
+                except sqlite3.OperationalError:
+                    break
+        primaryKeyColumns = sorted([(row[5], row[1]) for row in tableInfo if row[5] > 0])
+        return [quoteIdentifier(columnName) for position, columnName in primaryKeyColumns]
+    
+    def approximateCount(self, name):
+        """Approximate number of rows in a table (or None if there isn't a cheap way to tell)"""
+        return self.cached(self.approximateCounts, name, lambda: self.findApproximateCount(name))
+    
+    def findApproximateCount(self, name):
+        if "sqlite_stat1" in self.tables:
+            columnNames, rows = self.query("SELECT stat FROM sqlite_stat1 WHERE tbl = ? LIMIT 1", (name,))
+            if len(rows) > 0 and rows[0][0]:
+                return int(rows[0][0].split()[0])
+        keyColumns = self.keyColumns(name)
+        if keyColumns[:1] in [["rowid"], ["_rowid_"], ["oid"]]:
+            columnNames, rows = self.query("SELECT max(%s) FROM %s" % (keyColumns[0], quoteIdentifier(name)))
+            return rows[0][0] or 0
+        return None
+    
+    def rowCount(self, name):
+        """Return the number of rows in a table, and whether that is exact (if it has been counted yet)"""
+        with self.lock:
+            if self.exactCounts.get(name) != None:
+                return self.exactCounts[name], True
+        return self.approximateCount(name), False
+    
+    def startCounting(self):
+        """Start counting the rows of each table in the background (if not started already)"""
+        with self.lock:
+            if self.countingStarted:
+                return
+            self.countingStarted = True
+        for name in self.tables:
+            countExecutor.submit(self.countRows, name)
+            
+    def countRows(self, name):
+        try:
+            columnNames, rows = self.query("SELECT count(*) FROM %s" % quoteIdentifier(name))
+            count = rows[0][0]
+        except sqlite3.Error: # (leave it as approximate)
+            count = None
+        with self.lock:
+            self.exactCounts[name] = count
+            
+    def isCounted(self, name):
+        with self.lock:
+            return name in self.exactCounts
+            
+    def countedTables(self):
+        """Number of tables which have finished being counted"""
+        with self.lock:
+            return len(self.exactCounts)
+    
+"""Metadata of recently used databases, keyed by URL and validator token, so that a database's
+metadata is discarded when the database changes"""
+databaseMetadataCache = LruCache(100)
+
+"""Threads counting rows of tables (see DatabaseMetadata.startCounting)"""
+countExecutor = concurrent.futures.ThreadPoolExecutor(2)
+
 @resourceTypeNameInModule("database", aptrowModule)
 class SqliteDatabase(Resource):
 
@@ -33,16 +537,77 @@ class SqliteDatabase(Resource):
     
     def checkExists(self):
         self.fileResource.checkExists()
+        
+    def validator(self, view):
+        """Validator from the database (see sourceValidator), but only once all its tables' rows have been
+        counted, as until then the page shows approximate counts, which will change. (This is checked 
+        with the database's metadata only if it is already loaded, so no queries are run.)"""
+        sourceValidator = self.sourceValidator()
+        if sourceValidator == None:
+            return None
+        metadata = self.loadedMetadata(sourceValidator)
+        if metadata == None or metadata.countedTables() < len(metadata.tables):
+            return None
+        return sourceValidator
+        
+    def sourceValidator(self):
+        """Validator from the database file, and, for a database on the local file system, 
+        its write-ahead log (if any) and data version (or None if it can't be read as a database)"""
+        fileValidator = self.fileResource.validator(None)
+        if fileValidator == None or not hasattr(self.fileResource, "path"):
+            return fileValidator
+        path = self.fileResource.path
+        walPath = path + "-wal"
+        walStat = os.stat(walPath) if os.path.exists(walPath) else None
+        walToken = None if walStat == None else (walStat.st_size, walStat.st_mtime_ns)
+        dataVersion = dataVersionMonitor.dataVersion(path)
+        if dataVersion == None: # (not a database, which the page will report)
+            return None
+        return Validator((fileValidator.token, walToken, dataVersion), fileValidator.lastModified)
     
     def connect(self):
-        return sqlite3.connect(getFileResourcePath(self.fileResource))
+        """Check out a read-only connection to the database from sqliteConnectionPool 
+        (to be used in a 'with' statement, which returns it to the pool). A database which isn't
+        a file on the local file system is loaded into memory if it is small enough (see DatabaseImageCache), 
+        or otherwise read from a copy which never changes, so it is opened as immutable."""
+        if hasattr(self.fileResource, "path"):
+            path = self.fileResource.path
+            fileStat = os.stat(path)
+            # (keyed by the file's identity as well as its path, so that connections to a database file which 
+            # has been replaced, for example by renaming another file over it, aren't reused)
+            return sqliteConnectionPool.checkout(("file", path, fileStat.st_dev, fileStat.st_ino), 
+                                                 lambda: openDatabaseFile(path))
+        keyAndImage = databaseImageCache.getImage(self.fileResource)
+        if keyAndImage != None:
+            key, image = keyAndImage
+            return sqliteConnectionPool.checkout(("image", key), lambda: openDatabaseImage(image))
+        path = getFileResourcePath(self.fileResource)
+        return sqliteConnectionPool.checkout(("immutableFile", path), lambda: openDatabaseFile(path, immutable = True))
+    
+    def metadata(self):
+        """The DatabaseMetadata for the current version of the database"""
+        sourceValidator = self.sourceValidator()
+        if sourceValidator == None:
+            return DatabaseMetadata(self)
+        return databaseMetadataCache.getOrCreate((self.url(), sourceValidator.token), 
+                                                 lambda: DatabaseMetadata(self))
+    
+    def loadedMetadata(self, sourceValidator):
+        """The DatabaseMetadata for the version of the database with the given validator, if it has already
+        been loaded (otherwise None)"""
+        return databaseMetadataCache.peek((self.url(), sourceValidator.token))
     
     def listTables(self):
-        with self.connect() as connection:
-            cursor = connection.cursor()
-            cursor.execute ("SELECT name FROM sqlite_master WHERE type = \"table\"")
-            for row in cursor:
-                yield row[0]
+        return self.metadata().tables
+    
+    def rowCountDescription(self, metadata, name):
+        count, exact = metadata.rowCount(name)
+        if exact:
+            return "%s rows" % count
+        elif count != None:
+            return "about %s rows" % count
+        else:
+            return "row count not known yet"
                 
     @staticmethod
     @interpretationOf(fileLikeResource)
@@ -54,6 +619,8 @@ class SqliteDatabase(Resource):
         """HTML content for this resource. Link back to base file resource, and list
         items within the file."""
         yield tag.P("Resource ", tag.B(self.fileResource.htmlLink()), " interpreted as a Sqlite database")
+        yield tag.H2("Query")
+        yield self.queryForm()
         yield tag.H2("Master Tables")
         yield tag.UL().start()
         for tableName in ['sqlite_master']:
@@ -61,15 +628,38 @@ class SqliteDatabase(Resource):
             yield tag.LI(tag.A(h(table.name), href = table.url()))
         yield tag.UL().end()
         yield tag.H2("Tables")
+        metadata = self.metadata()
+        metadata.startCounting()
         yield tag.UL().start()
-        for tableName in self.listTables():
+        for tableName in metadata.tables:
             table = self.table(tableName)
-            yield tag.LI(tag.A(h(table.name), href = table.url()))
+            yield tag.LI(tag.A(h(table.name), href = table.url()), 
+                         " (%s)" % self.rowCountDescription(metadata, tableName))
         yield tag.UL().end()
         
     @attribute(StringParam("name"))
     def table(self, name):
         return SqliteTable(self, name)
+    
+    @attribute(StringParam("sql"), StringParam("params", optional = True), StringParam("limit", optional = True))
+    def query(self, sql, params, limit):
+        """Results of a read-only query"""
+        return SqliteQuery(self, sql, params, limit)
+    
+    def queryForm(self, sql = "", params = None, limit = None):
+        """Form for running a query (see SqliteQuery)"""
+        action, formParams, count = self.formActionParamsAndCount()
+        count += 1
+        return tag.formWithParams(action, formParams, 
+                                  tag.INPUT(name = "_%s" % count, value = "query", type = "hidden"), 
+                                  tag.TEXTAREA(h(sql), name = "_%s.sql" % count, rows = 6, cols = 80), tag.BR(), 
+                                  "Parameters: ", 
+                                  tag.INPUT(name = "_%s.params" % count, type = "text", size = 40, 
+                                            value = quoteAttribute(params or "")), tag.NBSP, 
+                                  "Row limit: ", 
+                                  tag.INPUT(name = "_%s.limit" % count, type = "text", size = 8, 
+                                            value = quoteAttribute(limit or "")), tag.NBSP, 
+                                  tag.INPUT(type = "submit", value = "Run query"))
 
 @resourceTypeNameInModule("table", aptrowModule)
 class SqliteTable(Resource):
@@ -88,36 +678,369 @@ class SqliteTable(Resource):
     
     def checkExists(self):
         self.database.checkExists()
-        tableExists = False
         if self.name == "sqlite_master":
             return
-        with self.database.connect() as connection:
-            cursor = connection.cursor()
-            cursor.execute ("SELECT name FROM sqlite_master WHERE type = \"table\" and name = ?", (self.name, ))
-            for row in cursor:
-                tableExists = True
-        if not tableExists:
+        if self.name not in self.database.metadata().tables:
             raise NoSuchObjectException("No table %s in %s" %(self.name, self.database.heading()))
         
-    def listQueryResults(self, query, args = []):
+    def validator(self, view):
+        """Validator from the database, but only once the table's rows have been counted 
+        (see SqliteDatabase.validator)"""
+        sourceValidator = self.database.sourceValidator()
+        if sourceValidator == None:
+            return None
+        if self.name != "sqlite_master":
+            metadata = self.database.loadedMetadata(sourceValidator)
+            if metadata == None or not metadata.isCounted(self.name):
+                return None
+        return sourceValidator
+        
+    def defaultView(self):
+        return View("rows")
+        
+    fetchBatchSize = 1000
+    
+    pageSize = 100
+    maxPageSize = 10000
+    
+    def metadataHtmlTable(self, columnNamesAndRows):
+        columnNames, rows = columnNamesAndRows
+        yield tag.TABLE(border = 1).start()
+        yield htmlTableRows([columnNames])
+        yield htmlTableRows(rows)
+        yield tag.TABLE().end()
+        
+    def pageParams(self, view):
+        """Page size, and the key (as a tuple) of the row which the page starts after or ends before 
+        (from view parameters 'size', 'after' and 'before', the keys being Python literals)"""
+        try:
+            size = min(max(int(view.params.get("size", self.pageSize)), 1), self.maxPageSize)
+        except ValueError:
+            raise ParameterException("Invalid page size: %r" % view.params.get("size"))
+        keys = []
+        for name in ["after", "before"]:
+            value = view.params.get(name)
+            if value != None:
+                try:
+                    value = ast.literal_eval(value)
+                except (ValueError, SyntaxError):
+                    value = None
+                if type(value) != tuple:
+                    raise ParameterException("Invalid %s key: %r" % (name, view.params.get(name)))
+            keys.append(value)
+        return size, keys[0], keys[1]
+    
+    def rowsPage(self, connection, keyColumns, size, after, before):
+        """Fetch one page of rows (each with its key columns first), using the key of the row before 
+        or after it, so that a page is found by an index lookup however far into the table it is. 
+        Return the column names, the rows, and whether there are rows before and after the page."""
+        keyList = ", ".join(keyColumns)
+        query = "SELECT %s, * FROM %s" % (keyList, quoteIdentifier(self.name))
+        if before != None:
+            query += " WHERE (%s) < (%s)" % (keyList, ", ".join(["?"] * len(before)))
+            order = " DESC"
+        else:
+            if after != None:
+                query += " WHERE (%s) > (%s)" % (keyList, ", ".join(["?"] * len(after)))
+            order = ""
+        query += " ORDER BY %s LIMIT ?" % ", ".join([column + order for column in keyColumns])
+        cursor = connection.execute(query, list(before or after or ()) + [size+1])
+        try:
+            columnNames = [desc[0] for desc in cursor.description]
+            rows = cursor.fetchall() # (at most one page)
+        finally:
+            cursor.close()
+        more = len(rows) > size
+        rows = rows[:size]
+        if before != None:
+            rows.reverse()
+            return columnNames, rows, more, True
+        else:
+            return columnNames, rows, after != None, more
+        
+    def rowsPageHtml(self, view):
+        size, after, before = self.pageParams(view)
+        keyColumns = self.database.metadata().keyColumns(self.name)
         with self.database.connect() as connection:
-            cursor = connection.cursor()
-            cursor.execute (query, *args)
-            yield (True, [desc[0] for desc in cursor.description])
-            for row in cursor:
-                yield (False, row)
-                
-    def listQueryResultsInHtmlTable(self, query, args = []):
+            if len(keyColumns) == 0:
+                raise NoSuchObjectException("No rowid or primary key in %s" % self.heading())
+            columnNames, rows, hasPrevious, hasNext = self.rowsPage(connection, keyColumns, size, after, before)
+        keyCount = len(keyColumns)
+        sizeParams = {} if size == self.pageSize else {"size": str(size)}
+        links = [tag.A("first", href = self.url(view = View("rows", sizeParams)))]
+        if hasPrevious and len(rows) > 0:
+            previousParams = dict(sizeParams, before = repr(tuple(rows[0][:keyCount])))
+            links.append(tag.A("previous", href = self.url(view = View("rows", previousParams))))
+        if hasNext and len(rows) > 0:
+            nextParams = dict(sizeParams, after = repr(tuple(rows[-1][:keyCount])))
+            links.append(tag.A("next", href = self.url(view = View("rows", nextParams))))
+        yield tag.P(spacedList(links), " (%s rows per page)" % size)
         yield tag.TABLE(border = 1).start()
-        for isHeader, row in self.listQueryResults(query):
-            yield tag.TR([tag.TD(h(str(item))) for item in row])
+        yield htmlTableRows([columnNames], keyCount)
+        for start in range(0, len(rows), self.fetchBatchSize):
+            yield htmlTableRows(rows[start:start+self.fetchBatchSize], keyCount)
         yield tag.TABLE().end()
+        yield tag.P(spacedList(links))
+    
+    """Exporters for view types which export the whole table (instead of showing it as HTML)"""
+    exporters = {"csv": CsvExporter, "ndjson": NdjsonExporter}
+    
+    exportBatchSize = 1000
+    
+    def page(self, app, view):
+        exporterClass = self.exporters.get(view.type)
+        if exporterClass == None:
+            return Resource.page(self, app, view)
+        else:
+            return self.exportPage(app, exporterClass)
+        
+    def exportPage(self, app, exporterClass):
+        """Stream every row of the table in an export format (see exportRows)"""
+        markPageUncacheable()
+        with self.database.connect() as connection:
+            cursor = connection.execute("SELECT * FROM %s" % quoteIdentifier(self.name))
+            try:
+                for chunk in exportRows(app, cursor, exporterClass, 
+                                        lambda: cursor.fetchmany(self.exportBatchSize)): 
+                    yield chunk
+            finally:
+                cursor.close()
     
     def html(self, view):
         """HTML content for this resource. Link back to base file resource, and list
         items within the file."""
-        yield tag.P(tag.A("Database", href = self.database.url()))
+        yield tag.P(tag.A("Database", href = self.database.url()), " Export: ", 
+                    spacedList([tag.A(viewType, href = self.url(view = View(viewType))) 
+                                for viewType in sorted(self.exporters.keys())]))
+        metadata = self.database.metadata()
         yield tag.H2("Table Info")
-        for element in self.listQueryResultsInHtmlTable("pragma table_info(\"%s\")" % self.name): yield element
+        for element in self.metadataHtmlTable(metadata.tableInfo(self.name)): yield element
+        indexColumnNames, indexRows = metadata.indexList(self.name)
+        if len(indexRows) > 0:
+            yield tag.H2("Indexes")
+            for element in self.metadataHtmlTable((indexColumnNames, indexRows)): yield element
         yield tag.H2("Rows")
-        for element in self.listQueryResultsInHtmlTable("SELECT * FROM \"%s\"" % self.name): yield element
+        if self.name != "sqlite_master":
+            yield tag.P(self.database.rowCountDescription(metadata, self.name).capitalize())
+        if view.type != "rows":
+            raise UnknownViewTypeException(view.type)
+        for element in self.rowsPageHtml(view): yield element
+
+class QueryBudget:
+    """Time budget for running a query, enforced by a progress handler (see 'check') which sqlite
+    calls every 'steps' virtual machine instructions. Only time spent in sqlite counts (not time 
+    spent waiting for results to be sent), as measured between calls to 'start' and 'stop'."""
+    
+    def __init__(self, seconds, steps):
+        self.seconds = seconds
+        self.steps = steps
+        self.elapsed = 0.0
+        self.startTime = None
+        self.progressCalls = 0
+        self.exceeded = False
+        
+    def start(self):
+        self.startTime = time.time()
+        
+    def stop(self):
+        self.elapsed += time.time() - self.startTime
+        self.startTime = None
+        
+    def check(self):
+        """Progress handler: a non-zero result makes sqlite interrupt the query"""
+        self.progressCalls += 1
+        if self.startTime != None and self.elapsed + (time.time() - self.startTime) > self.seconds:
+            self.exceeded = True
+            return 1
+        return 0
+    
+    def run(self, function, *args):
+        """Call function (a call into sqlite) as part of the budgeted time"""
+        self.start()
+        try:
+            return function(*args)
+        finally:
+            self.stop()
+    
+@resourceTypeNameInModule("query", aptrowModule)
+class SqliteQuery(Resource):
+    
+    """A resource representing the results of a query on a sqlite database, with optional parameters 
+    (given as a Python literal tuple). The query is run on a pooled connection with an authorizer that 
+    only allows reading, and a time budget; at most 'limit' rows of results are shown. The page shows
+    the query plan, the results (as they are fetched), and the time taken. The results can also be 
+    exported as CSV or NDJSON (see exporters)."""
+    
+    resourceParams = [ResourceParam("database"), StringParam("sql"), 
+                      StringParam("params", optional = True), StringParam("limit", optional = True)]
+    
+    timeBudget = 10.0
+    progressSteps = 1000
+    defaultLimit = 1000
+    maxLimit = 100000
+    
+    def init(self, database, sql, params = None, limit = None):
+        self.database = database
+        self.sql = sql
+        self.params = params
+        self.limit = limit
+        
+    def heading(self):
+        """Default heading to describe this resource (plain text, no HTML)"""
+        return "Query %r on %s" % (self.sql, self.database.heading())
+    
+    def checkExists(self):
+        self.database.checkExists()
+        self.queryParams()
+        self.rowLimit()
+        
+    def queryParams(self):
+        if self.params == None or self.params.strip() == "":
+            return ()
+        try:
+            params = ast.literal_eval(self.params)
+        except (ValueError, SyntaxError):
+            params = None
+        if type(params) == list:
+            params = tuple(params)
+        elif type(params) != tuple:
+            params = (params,) if params != None else None
+        if params == None:
+            raise ParameterException("Invalid query parameters: %r" % self.params)
+        return params
+    
+    def rowLimit(self):
+        if self.limit == None or self.limit.strip() == "":
+            return self.defaultLimit
+        try:
+            return min(max(int(self.limit), 1), self.maxLimit)
+        except ValueError:
+            raise ParameterException("Invalid row limit: %r" % self.limit)
+        
+    def queryPlanHtml(self, planRows):
+        """The rows of 'EXPLAIN QUERY PLAN' (id, parent, unused, detail) shown as an indented tree"""
+        depths = {0: 0}
+        lines = []
+        for row in planRows:
+            depth = depths.get(row[1], 0) + 1
+            depths[row[0]] = depth
+            lines.append("%s%s" % ("  " * (depth-1), h(str(row[3]))))
+        return tag.PRE("\n".join(lines))
+    
+    def resultsHtml(self, connection, budget, params, limit):
+        """The plan, results and statistics of running the query"""
+        try:
+            planCursor = budget.run(connection.execute, "EXPLAIN QUERY PLAN %s" % self.sql, params)
+            try:
+                planRows = budget.run(planCursor.fetchall)
+            finally:
+                planCursor.close()
+        except (sqlite3.Error, sqlite3.Warning) as error:
+            yield self.errorHtml(error, budget)
+            return
+        yield tag.H2("Query plan")
+        yield self.queryPlanHtml(planRows)
+        yield tag.H2("Results")
+        tableStarted = False
+        rowCount = 0
+        truncated = False
+        try:
+            cursor = budget.run(connection.execute, self.sql, params)
+            try:
+                yield tag.TABLE(border = 1).start()
+                tableStarted = True
+                yield htmlTableRows([[desc[0] for desc in cursor.description or []]])
+                while rowCount < limit:
+                    rows = budget.run(cursor.fetchmany, min(SqliteTable.fetchBatchSize, limit - rowCount + 1))
+                    if len(rows) == 0:
+                        break
+                    if rowCount + len(rows) > limit:
+                        rows = rows[:limit - rowCount]
+                        truncated = True
+                    rowCount += len(rows)
+                    yield htmlTableRows(rows)
+                if rowCount == limit and not truncated:
+                    truncated = len(budget.run(cursor.fetchmany, 1)) > 0
+            finally:
+                cursor.close()
+        except (sqlite3.Error, sqlite3.Warning) as error:
+            if tableStarted:
+                yield tag.TABLE().end()
+            yield self.errorHtml(error, budget)
+            return
+        yield tag.TABLE().end()
+        yield tag.P("%s rows%s" % (rowCount, " (limit reached, more rows not shown)" if truncated else ""))
+        yield self.statisticsHtml(budget)
+        
+    def errorHtml(self, error, budget):
+        if budget.exceeded:
+            message = tag.P(tag.B("Query stopped: time budget of %s seconds used up" % self.timeBudget))
+        else:
+            message = tag.P(tag.B("Query failed: "), h(str(error)))
+        return [message, self.statisticsHtml(budget)]
+        
+    def statisticsHtml(self, budget):
+        return tag.P("Execution time: %.3f seconds (budget %s seconds); about %s virtual machine steps" 
+                     % (budget.elapsed, self.timeBudget, budget.progressCalls * budget.steps))
+    
+    """Exporters for view types which export the results (all of them, or at most 'limit' rows if it 
+    is given) instead of showing them as HTML"""
+    exporters = SqliteTable.exporters
+    
+    def page(self, app, view):
+        exporterClass = self.exporters.get(view.type) if view != None else None
+        if exporterClass == None:
+            return Resource.page(self, app, view)
+        else:
+            return self.exportPage(app, exporterClass)
+        
+    def exportPage(self, app, exporterClass):
+        """Run the query (with the same authorizer and time budget as for the HTML page), and stream 
+        its results in an export format (see exportRows). An error before any results are sent is reported 
+        as an invalid parameter; the response to a query which fails after that (for example, by using up 
+        its time budget) is cut short."""
+        markPageUncacheable()
+        params = self.queryParams()
+        limit = None if self.limit == None or self.limit.strip() == "" else self.rowLimit()
+        budget = QueryBudget(self.timeBudget, self.progressSteps)
+        with self.database.connect() as connection:
+            connection.set_authorizer(readOnlyAuthorizer)
+            connection.set_progress_handler(budget.check, self.progressSteps)
+            try:
+                try:
+                    cursor = budget.run(connection.execute, self.sql, params)
+                except (sqlite3.Error, sqlite3.Warning) as error:
+                    raise ParameterException("Query failed: %s" % error)
+                rowCounts = [0]
+                def fetchRows():
+                    size = SqliteTable.exportBatchSize
+                    if limit != None:
+                        size = min(size, limit - rowCounts[0])
+                        if size <= 0:
+                            return []
+                    rows = budget.run(cursor.fetchmany, size)
+                    rowCounts[0] += len(rows)
+                    return rows
+                try:
+                    for chunk in exportRows(app, cursor, exporterClass, fetchRows): yield chunk
+                finally:
+                    cursor.close()
+            finally:
+                connection.set_authorizer(None)
+                connection.set_progress_handler(None, 0)
+    
+    def html(self, view):
+        """Run the query and show its results, as they are fetched"""
+        yield tag.P(tag.A("Database", href = self.database.url()), " Export: ", 
+                    spacedList([tag.A(viewType, href = self.url(view = View(viewType))) 
+                                for viewType in sorted(self.exporters.keys())]))
+        yield self.database.queryForm(self.sql, self.params, self.limit)
+        budget = QueryBudget(self.timeBudget, self.progressSteps)
+        with self.database.connect() as connection:
+            connection.set_authorizer(readOnlyAuthorizer)
+            connection.set_progress_handler(budget.check, self.progressSteps)
+            try:
+                for text in self.resultsHtml(connection, budget, self.queryParams(), self.rowLimit()): yield text
+            finally:
+                connection.set_authorizer(None)
+                connection.set_progress_handler(None, 0)
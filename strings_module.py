@@ -34,6 +34,10 @@ class String(Resource):
         """Default heading to describe this resource (plain text, no HTML)"""
         return "String: %r" % self.value
     
+    def validator(self, view):
+        """Everything about the resource is in its URL, so it never changes"""
+        return Validator(("string",))
+    
     def html(self, view):
         """HTML content for string: show it in bold."""
         yield tag.P("String: ", tag.B(h(self.value)))
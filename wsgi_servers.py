@@ -0,0 +1,490 @@
+""" Copyright 2009 Philip Dorrell http://www.1729.com/ (email: http://www.1729.com/email.html)
+
+  This file is part of Aptrow ("Advance Programming Technology Read-Only Webification": http://www.1729.com/aptrow/)
+
+  Aptrow is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+  as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+  Aptrow is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+  of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License along with Aptrow (as license-gplv3.txt).
+  If not, see <http://www.gnu.org/licenses/>."""
+
+"""WSGI servers for running the Aptrow application (see runAptrowServer in aptrow.py)"""
+
+import io
+import os
+import queue
+import select
+import signal
+import socket
+import threading
+import time
+import traceback
+
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+
+class KeepAliveServerHandler(ServerHandler):
+    """Handler for one WSGI request on a persistent HTTP/1.1 connection. 
+    The response is length-delimited when the application (or wsgiref, for single-item 
+    results) gives a Content-Length, otherwise it is sent with chunked transfer encoding 
+    to HTTP/1.1 clients (or delimited by closing the connection for HTTP/1.0 clients).
+    Any text (str) output is encoded as UTF-8. Small writes are
+    buffered, and sent once they amount to 'chunkSize' bytes, or when 'chunkSeconds' 
+    seconds have passed since the last send."""
+    
+    http_version = "1.1"
+    chunkSize = 16384
+    chunkSeconds = 0.1
+    
+    chunked = False
+    hasBody = True
+    
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        requestHandler = self.request_handler
+        statusCode = int(self.status.split()[0])
+        # (A HEAD response keeps any Content-Length the application gave, i.e. that of the GET response.)
+        self.hasBody = statusCode >= 200 and statusCode not in (204, 304) and self.environ["REQUEST_METHOD"] != "HEAD"
+        if 'Content-Length' not in self.headers and self.hasBody:
+            if self.environ["SERVER_PROTOCOL"] == "HTTP/1.1":
+                self.headers['Transfer-Encoding'] = "chunked"
+                self.chunked = True
+            else:
+                requestHandler.close_connection = True
+        if getattr(requestHandler.server, "stopping", False): # (see PreforkServer.runWorker)
+            requestHandler.close_connection = True
+        if requestHandler.close_connection:
+            self.headers['Connection'] = "close"
+        elif self.environ["SERVER_PROTOCOL"] != "HTTP/1.1":
+            self.headers['Connection'] = "keep-alive"
+        self.buffer = []
+        self.bufferSize = 0
+        self.lastSendTime = time.time()
+            
+    def write(self, data):
+        if type(data) is str:
+            data = data.encode("utf-8")
+        if not self.status:
+            raise AssertionError("write() before start_response()")
+        if not self.headers_sent:
+            self.bytes_sent = 0
+            self.send_headers()
+        if not self.hasBody: # (whatever the application produces, as the next response follows at once)
+            return
+        self.bytes_sent += len(data)
+        if len(data) > 0:
+            self.buffer.append(data)
+            self.bufferSize += len(data)
+            if self.bufferSize >= self.chunkSize or time.time() - self.lastSendTime >= self.chunkSeconds:
+                self.sendBuffer()
+                
+    def sendBuffer(self):
+        if self.bufferSize > 0:
+            data = b"".join(self.buffer)
+            if self.chunked:
+                self._write(("%x\r\n" % len(data)).encode("ascii"))
+                self._write(data)
+                self._write(b"\r\n")
+            else:
+                self._write(data)
+            self._flush()
+            self.buffer = []
+            self.bufferSize = 0
+        self.lastSendTime = time.time()
+                
+    def finish_content(self):
+        ServerHandler.finish_content(self)
+        self.sendBuffer()
+        if self.chunked:
+            self._write(b"0\r\n\r\n")
+            self._flush()
+            
+    def sendfile(self):
+        """Send a result wrapped with 'wsgi.file_wrapper' directly from the file to the socket, 
+        if it is a real file and the response has a Content-Length."""
+        fileLike = self.result.filelike
+        contentLength = self.headers.get('Content-Length')
+        try:
+            fileLike.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return False
+        if contentLength == None:
+            return False
+        if not self.headers_sent:
+            self.bytes_sent = 0
+            self.send_headers()
+        if not self.hasBody:
+            return True
+        self.sendBuffer()
+        # (socket.sendfile leaves the file positioned after the data sent, and returns how much that was)
+        self.bytes_sent = self.request_handler.connection.sendfile(fileLike, fileLike.tell(), int(contentLength))
+        return True
+    
+    def handle_error(self):
+        """If the response has already started, the only way to tell the client it is 
+        incomplete is to close the connection (without sending the final chunk)."""
+        if self.headers_sent:
+            self.request_handler.close_connection = True
+        ServerHandler.handle_error(self)
+        
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """Request handler which serves successive (possibly pipelined) requests on one connection,
+    until the client asks to close it, or it has been idle for 'timeout' seconds.
+    (Pipelined requests are simply read in turn from the buffered input stream.)
+    Note that an open connection occupies its handling thread or process until it is closed, 
+    so this suits "threaded" mode best. 
+    (Output is already buffered by KeepAliveServerHandler, so Nagle's algorithm is disabled, 
+    which would otherwise delay a short response written after its headers.)"""
+    
+    protocol_version = "HTTP/1.1"
+    timeout = 15
+    disable_nagle_algorithm = True
+    maxDrainedRequestBody = 65536
+    
+    def handle(self):
+        self.close_connection = True
+        self.handleOneRequest()
+        while not self.close_connection and not getattr(self.server, "stopping", False):
+            self.handleOneRequest(waiting = True)
+            
+    def handleOneRequest(self, waiting = False):
+        """Read and handle a request. If 'waiting' for another request on the connection, and the server 
+        keeps track of an 'idleConnection' (see CountingWSGIServer), the connection is recorded as idle 
+        until the request line has been read, so that a server asked to stop can close it."""
+        recordIdle = waiting and hasattr(self.server, "idleConnection")
+        try:
+            if recordIdle:
+                self.server.idleConnection = self.connection
+            try:
+                self.raw_requestline = self.rfile.readline(65537)
+            finally:
+                if recordIdle:
+                    self.server.idleConnection = None
+        except (socket.timeout, ConnectionError):
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) == 0:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = True
+            return
+        if not self.parse_request(): # An error code has been sent
+            self.close_connection = True
+            return
+        handler = KeepAliveServerHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ(),
+                                         multithread = getattr(self.server, "multithread", False))
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        self.skipRequestBody()
+        
+    def skipRequestBody(self):
+        """The application doesn't read request bodies, so skip any body before reading the next request
+        (or, if the body is chunked or too big to bother with, close the connection)."""
+        if self.headers.get("Transfer-Encoding") != None:
+            self.close_connection = True
+        else:
+            contentLength = int(self.headers.get("Content-Length") or "0")
+            if contentLength > self.maxDrainedRequestBody:
+                self.close_connection = True
+            elif contentLength > 0 and not self.close_connection:
+                self.rfile.read(contentLength)
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """A WSGI server which handles requests on a fixed pool of worker threads.
+    Accepted connections wait in a bounded queue. When the queue is full, the accept
+    loop blocks until a worker takes a connection off the queue (so that any further
+    connections wait in the socket's listen backlog instead of using up memory)."""
+
+    multithread = True
+
+    def __init__(self, serverAddress, handlerClass, workers = 8, queueSize = 64):
+        self.request_queue_size = max(queueSize, 5) # listen backlog, used by server_activate()
+        self.requestQueue = queue.Queue(queueSize)
+        self.workerThreads = []
+        WSGIServer.__init__(self, serverAddress, handlerClass)
+        for number in range(1, workers+1):
+            thread = threading.Thread(target = self.processQueuedRequests,
+                                      name = "aptrow-worker-%s" % number)
+            thread.daemon = True
+            thread.start()
+            self.workerThreads.append(thread)
+
+    def process_request(self, request, clientAddress):
+        """Called by the accept loop: queue the connection for the next free worker."""
+        self.requestQueue.put((request, clientAddress))
+
+    def processQueuedRequests(self):
+        """Main loop of each worker thread. A None entry in the queue tells the worker to stop."""
+        while True:
+            queued = self.requestQueue.get()
+            if queued == None:
+                return
+            request, clientAddress = queued
+            try:
+                self.finish_request(request, clientAddress)
+            except Exception:
+                self.handle_error(request, clientAddress)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        """Stop accepting connections, and let the workers finish what is already queued."""
+        WSGIServer.server_close(self)
+        for thread in self.workerThreads:
+            self.requestQueue.put(None)
+        for thread in self.workerThreads:
+            thread.join()
+
+class CountingWSGIServer(WSGIServer):
+    """A WSGI server that counts the requests it has handled (reported by pre-fork workers)"""
+    
+    requestsHandled = 0
+    multithread = False
+    stopping = False
+    idleConnection = None # a persistent connection waiting for its next request (see KeepAliveRequestHandler)
+    
+    def finish_request(self, request, clientAddress):
+        WSGIServer.finish_request(self, request, clientAddress)
+        self.requestsHandled += 1
+        
+    def get_request(self):
+        """Accept a connection, or raise BlockingIOError if there isn't one waiting (the listening 
+        socket of a pre-fork worker being non-blocking, see PreforkServer.runWorker), which
+        handle_request treats as no request. The accepted connection itself is blocking."""
+        request, clientAddress = WSGIServer.get_request(self)
+        request.setblocking(True)
+        return request, clientAddress
+
+class PreforkWorker:
+    """Information held by the parent process about one pre-forked worker process."""
+    
+    def __init__(self, number):
+        self.number = number
+        self.pid = None
+        self.heartbeatPipe = None
+        self.startTime = None
+        self.lastHeartbeat = None
+        self.requestsHandled = 0
+        self.restarts = 0
+        self.lastExitStatus = None
+        
+    def health(self, now, heartbeatTimeout):
+        """Short description of the state of this worker"""
+        if self.pid == None:
+            return "stopped"
+        elif now - self.lastHeartbeat > heartbeatTimeout:
+            return "unresponsive"
+        else:
+            return "ok"
+        
+    def healthReport(self, now, heartbeatTimeout):
+        return ("worker %s: pid %s, %s, up %.0fs, %s requests, last heartbeat %.1fs ago, %s restarts, last exit status %r"
+                % (self.number, self.pid, self.health(now, heartbeatTimeout), now - self.startTime, 
+                   self.requestsHandled, now - self.lastHeartbeat, self.restarts, self.lastExitStatus))
+
+class PreforkServer:
+    """Serve requests from N worker processes, forked from this (parent) process, which all accept 
+    connections on the one listening socket of a WSGI server created by the parent. 
+    Anything imported before serve_forever() is called (in particular all resource modules registered 
+    with addModule) is imported once in the parent and shared by the workers.
+    
+    The parent restarts workers which exit or crash, and kills and restarts workers which stop sending
+    heartbeats. On SIGTERM or SIGINT it shuts down gracefully: each worker finishes its current request
+    and exits (workers still running after 'shutdownTimeout' seconds are killed). 
+    On SIGUSR1 the parent prints a health report for each worker. 
+    Workers exit with os._exit (so as not to run exit handlers inherited from the parent), so if given,
+    'onWorkerExit(pid)' is called by the parent for each worker which has exited (or been killed), to
+    clean up anything the worker leaves behind."""
+    
+    heartbeatInterval = 2
+    heartbeatTimeout = 30
+    shutdownTimeout = 10
+    minimumLifetime = 1 # workers exiting sooner than this after starting are restarted after a delay
+    
+    def __init__(self, server, workers = 4, onWorkerExit = None):
+        self.server = server
+        self.onWorkerExit = onWorkerExit
+        self.workers = [PreforkWorker(number) for number in range(1, workers+1)]
+        self.stopping = False
+        self.reportRequested = False
+        
+    def startWorker(self, worker):
+        readFd, writeFd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(readFd)
+            for otherWorker in self.workers:
+                if otherWorker.pid != None:
+                    os.close(otherWorker.heartbeatPipe)
+            exitStatus = 0
+            try:
+                self.runWorker(writeFd)
+            except BaseException:
+                traceback.print_exc()
+                exitStatus = 1
+            finally:
+                os._exit(exitStatus)
+        os.close(writeFd)
+        worker.pid = pid
+        worker.heartbeatPipe = readFd
+        worker.startTime = worker.lastHeartbeat = time.time()
+        worker.requestsHandled = 0
+        
+    def runWorker(self, heartbeatFd):
+        """Main loop of a worker process: handle requests until asked to stop by the parent."""
+        workerStopping = []
+        def stopWorker(signum, frame):
+            workerStopping.append(signum)
+            # Persistent connections are closed after their current request, and an idle one at once 
+            # (its pending read then sees end of input), rather than after the keep-alive idle timeout
+            self.server.stopping = True
+            if self.server.idleConnection != None:
+                try:
+                    self.server.idleConnection.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+        signal.signal(signal.SIGTERM, stopWorker)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        def sendHeartbeats():
+            while True:
+                os.write(heartbeatFd, ("%s\n" % self.server.requestsHandled).encode("ascii"))
+                time.sleep(self.heartbeatInterval)
+        heartbeatThread = threading.Thread(target = sendHeartbeats, name = "aptrow-heartbeat")
+        heartbeatThread.daemon = True
+        heartbeatThread.start()
+        self.server.timeout = 0.5
+        # Non-blocking, as several workers may be woken for one connection, and those which don't 
+        # get it must go back to checking for the stop signal (rather than blocking in accept)
+        self.server.socket.setblocking(False)
+        while not workerStopping:
+            self.server.handle_request()
+            
+    def readHeartbeats(self, timeout):
+        workersByPipe = dict((worker.heartbeatPipe, worker) for worker in self.workers if worker.pid != None)
+        try:
+            readable, writable, errors = select.select(list(workersByPipe.keys()), [], [], timeout)
+        except InterruptedError:
+            return
+        for fd in readable:
+            worker = workersByPipe[fd]
+            data = os.read(fd, 4096)
+            if len(data) > 0:
+                worker.lastHeartbeat = time.time()
+                worker.requestsHandled = int(data.split()[-1])
+            
+    def reapWorkers(self):
+        """Collect exited workers (and restart them unless shutting down)"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            for worker in self.workers:
+                if worker.pid == pid:
+                    os.close(worker.heartbeatPipe)
+                    worker.pid = None
+                    worker.lastExitStatus = status
+                    if self.onWorkerExit != None:
+                        self.onWorkerExit(pid)
+                    if not self.stopping:
+                        print("Worker %s (pid %s) exited with status %s, restarting" % (worker.number, pid, status))
+                        if time.time() - worker.startTime < self.minimumLifetime:
+                            time.sleep(self.minimumLifetime)
+                        worker.restarts += 1
+                        self.startWorker(worker)
+                        
+    def killUnresponsiveWorkers(self):
+        now = time.time()
+        for worker in self.workers:
+            if worker.pid != None and worker.health(now, self.heartbeatTimeout) == "unresponsive":
+                print("Worker %s (pid %s) is unresponsive, killing it" % (worker.number, worker.pid))
+                os.kill(worker.pid, signal.SIGKILL)
+                
+    def printHealthReport(self):
+        now = time.time()
+        for worker in self.workers:
+            print(worker.healthReport(now, self.heartbeatTimeout))
+        
+    def serve_forever(self):
+        """Start the workers, then supervise them until SIGTERM or SIGINT is received"""
+        def stop(signum, frame):
+            self.stopping = True
+        def requestReport(signum, frame):
+            self.reportRequested = True
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGUSR1, requestReport)
+        for worker in self.workers:
+            self.startWorker(worker)
+        print("Started %s worker processes (parent pid %s)" % (len(self.workers), os.getpid()))
+        while not self.stopping:
+            self.readHeartbeats(self.heartbeatInterval)
+            self.reapWorkers()
+            self.killUnresponsiveWorkers()
+            if self.reportRequested:
+                self.reportRequested = False
+                self.printHealthReport()
+        self.shutdownWorkers()
+        
+    def shutdownWorkers(self):
+        """Ask all workers to stop after their current request, killing any that take too long"""
+        print("Shutting down worker processes ...")
+        for worker in self.workers:
+            if worker.pid != None:
+                os.kill(worker.pid, signal.SIGTERM)
+        deadline = time.time() + self.shutdownTimeout
+        while any(worker.pid != None for worker in self.workers) and time.time() < deadline:
+            self.reapWorkers()
+            time.sleep(0.1)
+        for worker in self.workers:
+            if worker.pid != None:
+                os.kill(worker.pid, signal.SIGKILL)
+        while any(worker.pid != None for worker in self.workers):
+            self.reapWorkers()
+            time.sleep(0.1)
+        self.printHealthReport()
+        
+    def set_app(self, app):
+        self.server.set_app(app)
+        
+    def server_close(self):
+        self.server.server_close()
+
+def makePreforkServer(serverAddress, handlerClass, workers = 4, queueSize = 64):
+    """Create the listening server in the parent process, to be shared by the worker processes"""
+    server = CountingWSGIServer(serverAddress, handlerClass)
+    return PreforkServer(server, workers = workers)
+
+"""Server classes (or factories) by mode name (as passed to runAptrowServer)"""
+serverModes = {"simple": WSGIServer,
+               "threaded": ThreadPoolWSGIServer, 
+               "prefork": makePreforkServer}
+
+def makeServer(host, port, app, mode = "simple", workers = 8, queueSize = 64, keepAlive = False, idleTimeout = 15):
+    """Create a WSGI server for app, of the type given by mode, listening on host:port.
+    'workers' is the number of worker threads for "threaded" mode, or of worker processes
+    for "prefork" mode. If keepAlive is True, connections are HTTP/1.1 persistent connections, 
+    closed after 'idleTimeout' seconds without a request."""
+    serverClass = serverModes.get(mode)
+    if serverClass == None:
+        raise ValueError("Unknown server mode %r (known modes: %s)" % (mode, ", ".join(serverModes.keys())))
+    if keepAlive:
+        handlerClass = type("KeepAliveRequestHandler", (KeepAliveRequestHandler,), {"timeout": idleTimeout})
+    else:
+        handlerClass = WSGIRequestHandler
+    if serverClass == WSGIServer:
+        server = WSGIServer((host, port), handlerClass)
+    else:
+        server = serverClass((host, port), handlerClass, workers = workers, queueSize = queueSize)
+    server.set_app(app)
+    return server
@@ -13,12 +13,341 @@
 
 from aptrow import *
 import zipfile
+import collections
+import bisect
+import struct
+import shutil
 import htmltags as tag
 
 # Aptrow module enabling a "file-like" resource to be intrepreted as a zip file
 # (and presenting items within a zip file as "file-like" resources).
 
 aptrowModule = ResourceModule()
+
+class ZipIndex:
+    """An index of the items in a zip file, built once from its list of ZipInfo's: the names in 
+    sorted order (so that items with a given prefix are found by binary search), and a map from each 
+    directory path ('' for the root, otherwise ending in '/') to the names of its immediate children. 
+    The directory map includes 'implied' directories, i.e. those which have no item of their own, 
+    but do have items within them."""
+    
+    def __init__(self, zipInfos):
+        self.zipInfos = zipInfos
+        self.zipInfosByName = {}
+        for zipInfo in zipInfos:
+            self.zipInfosByName.setdefault(zipInfo.filename, zipInfo)
+        self.names = sorted(self.zipInfosByName.keys())
+        self.children = {"": []}
+        for name in self.names:
+            self.addChild(name)
+            
+    def addChild(self, name):
+        """Add name to the children of its directory (adding the directory to its parent if it is new)"""
+        slashPos = name.rfind("/", 0, len(name)-1)
+        dirPath = name[:slashPos+1]
+        if dirPath not in self.children:
+            self.addChild(dirPath)
+        if name.endswith("/"):
+            if name in self.children:
+                return
+            self.children[name] = []
+        self.children[dirPath].append(name)
+        
+    def getZipInfo(self, name):
+        """Return ZipInfo for named item (or None)"""
+        return self.zipInfosByName.get(name)
+    
+    def isDirectory(self, path):
+        """Does the directory exist (either as an item, or implied by items within it)?"""
+        return path in self.children
+    
+    def childNames(self, path):
+        """Names of the immediate children of a directory"""
+        return self.children.get(path, [])
+        
+    def zipInfosWithPrefix(self, prefix):
+        """ZipInfo's for items whose names start with prefix, in name order"""
+        zipInfos = []
+        for pos in range(bisect.bisect_left(self.names, prefix), len(self.names)):
+            name = self.names[pos]
+            if not name.startswith(prefix):
+                break
+            zipInfos.append(self.zipInfosByName[name])
+        return zipInfos
+
+class PooledZipFileEntry:
+    """An open zipfile.ZipFile held in a ZipFilePool, with a count of current users 
+    (and the ZipIndex for the zip file, once it has been needed)."""
+    def __init__(self, key, zipFile):
+        self.key = key
+        self.zipFile = zipFile
+        self.users = 0
+        self.discarded = False
+        self.index = None
+        
+class PooledZipFile:
+    """A zipfile.ZipFile checked out from a ZipFilePool, with the same read-only methods. 
+    Close it (or use it in a 'with' statement) to return it to the pool."""
+    def __init__(self, pool, entry):
+        self.pool = pool
+        self.entry = entry
+        self.closed = False
+        
+    def __getattr__(self, name):
+        return getattr(self.entry.zipFile, name)
+    
+    def getIndex(self):
+        """The ZipIndex for this zip file (built once, and kept for as long as the zip file is in the pool)"""
+        if self.entry.index == None:
+            self.entry.index = ZipIndex(self.entry.zipFile.infolist())
+        return self.entry.index
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.pool.checkin(self.entry)
+
+def archiveIdentity(fileResource):
+    """A key identifying the current contents of a 'file-like' resource containing a zip file:
+    ("file", path, size, modification time) for a file on the local file system, or 
+    ("item", <identity of containing zip file>, name, CRC, size) for an item within a zip file.
+    Returns None if the contents can't be identified (so shouldn't be cached)."""
+    if hasattr(fileResource, "path"):
+        fileStat = os.stat(fileResource.path)
+        return ("file", fileResource.path, fileStat.st_size, fileStat.st_mtime_ns)
+    elif isinstance(fileResource, ZipItem):
+        return fileResource.identity()
+    else:
+        return None
+    
+def identityLastModified(identity):
+    """Modification time of the file on the local file system that an archive identity derives from"""
+    if identity[0] == "file":
+        return identity[3] / 1e9
+    else:
+        return identityLastModified(identity[1])
+    
+def identitySource(identity):
+    """The part of an archive identity which says where it comes from (but not which version of it)"""
+    if identity[0] == "file":
+        return ("file", identity[1])
+    else:
+        return ("item", identitySource(identity[1]), identity[2])
+
+class ZipFilePool:
+    """A process-wide pool of open zipfile.ZipFile objects, so that a zip file's central directory 
+    is read once, and not every time the zip file is looked at.
+    Entries are keyed by archive identity (see archiveIdentity), so a zip file which has changed is opened 
+    afresh (and the entry for the old version is discarded). At most 'maxOpenFiles' zip files are kept 
+    open, least recently used ones being closed first. One zipfile.ZipFile may be used by several threads
+    at once (as zipfile synchronises reads from the underlying file); a discarded ZipFile is only closed 
+    when its last user has returned it."""
+    
+    def __init__(self, maxOpenFiles = 64):
+        self.maxOpenFiles = maxOpenFiles
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.keysBySource = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        
+    def checkout(self, key, openZipFile):
+        """Return a PooledZipFile for the zip file with identity 'key' (to be closed after use), 
+        calling openZipFile() to open it if it isn't already in the pool."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                entry.users += 1
+                return PooledZipFile(self, entry)
+            self.misses += 1
+        newEntry = PooledZipFileEntry(key, openZipFile())
+        source = identitySource(key)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry == None:
+                entry = newEntry
+                oldKey = self.keysBySource.get(source)
+                if oldKey != None:
+                    self.discard(oldKey)
+                    self.invalidations += 1
+                self.entries[key] = entry
+                self.keysBySource[source] = key
+                while len(self.entries) > self.maxOpenFiles:
+                    self.discard(next(iter(self.entries)))
+                    self.evictions += 1
+            else:
+                newEntry.zipFile.close()
+            entry.users += 1
+            return PooledZipFile(self, entry)
+        
+    def discard(self, key):
+        """Remove an entry from the pool (called with lock held), closing it if it isn't being used"""
+        entry = self.entries.pop(key)
+        del self.keysBySource[identitySource(key)]
+        entry.discarded = True
+        if entry.users == 0:
+            entry.zipFile.close()
+            
+    def checkin(self, entry):
+        with self.lock:
+            entry.users -= 1
+            if entry.discarded and entry.users == 0:
+                entry.zipFile.close()
+                
+    def stats(self):
+        with self.lock:
+            return {"openFiles": len(self.entries), "maxOpenFiles": self.maxOpenFiles, 
+                    "hits": self.hits, "misses": self.misses, 
+                    "evictions": self.evictions, "invalidations": self.invalidations}
+    
+"""The pool of open zip files shared by all ZipFile resources"""
+zipFilePool = ZipFilePool()
+
+class ClosingZipFile(zipfile.ZipFile):
+    """A zipfile.ZipFile read from a file-like object, which closes that object when it is closed"""
+    def __init__(self, binaryFile):
+        zipfile.ZipFile.__init__(self, binaryFile, "r")
+        self.binaryFile = binaryFile
+        
+    def close(self):
+        zipfile.ZipFile.close(self)
+        self.binaryFile.close()
+        
+class DecompressedItemCache:
+    """Decompressed copies of compressed zip items (such as zip files within zip files, which need 
+    random access to be read), keyed by item identity, so that each item is only decompressed once. 
+    Copies are kept in memory, up to 'memoryBudget' bytes in total. Items bigger than 'maxMemoryItemSize', 
+    and items pushed out of memory by more recently used items, are spilled to temporary files, 
+    up to 'diskBudget' bytes in total (the least recently used files being deleted first). 
+    The temporary files are in the current process's directory of spillFileCache (so they are deleted
+    when the process exits, or, if it can't delete them itself, by the next server to start)."""
+    
+    def __init__(self, memoryBudget = 64*1024*1024, maxMemoryItemSize = 16*1024*1024, diskBudget = 1024*1024*1024):
+        self.memoryBudget = memoryBudget
+        self.maxMemoryItemSize = maxMemoryItemSize
+        self.diskBudget = diskBudget
+        self.lock = threading.Lock()
+        self.memoryEntries = collections.OrderedDict()
+        self.diskEntries = collections.OrderedDict()
+        self.memoryUsed = 0
+        self.diskUsed = 0
+        self.spillDir = None
+        self.spillProcessId = None
+        self.hits = 0
+        self.misses = 0
+        self.spills = 0
+        
+    def get(self, key):
+        """Return an open random-access file for the cached copy of the item (or None if not cached)"""
+        with self.lock:
+            data = self.memoryEntries.get(key)
+            if data != None:
+                self.memoryEntries.move_to_end(key)
+                self.hits += 1
+                return io.BytesIO(data)
+            entry = self.diskEntries.get(key)
+            if entry != None and self.spillProcessId == os.getpid():
+                self.diskEntries.move_to_end(key)
+                self.hits += 1
+                return open(entry[0], "rb")
+            return None
+        
+    def open(self, key, size, openItem):
+        """Return an open random-access file for the cached copy of an item of given (decompressed) size, 
+        calling openItem() to read the item if it isn't already cached."""
+        cachedFile = self.get(key)
+        if cachedFile != None:
+            return cachedFile
+        with self.lock:
+            self.misses += 1
+        with openItem() as itemFile:
+            if size <= self.maxMemoryItemSize and size <= self.memoryBudget:
+                data = itemFile.read()
+                self.storeInMemory(key, data)
+                return io.BytesIO(data)
+            else:
+                return open(self.writeToDisk(key, itemFile), "rb")
+            
+    def storeInMemory(self, key, data):
+        spilled = []
+        with self.lock:
+            if key not in self.memoryEntries:
+                self.memoryEntries[key] = data
+                self.memoryUsed += len(data)
+            while self.memoryUsed > self.memoryBudget:
+                oldKey, oldData = self.memoryEntries.popitem(last = False)
+                self.memoryUsed -= len(oldData)
+                spilled.append((oldKey, oldData))
+        for oldKey, oldData in spilled:
+            self.writeToDisk(oldKey, io.BytesIO(oldData))
+            
+    def writeToDisk(self, key, itemFile):
+        """Copy item to a new temporary file, returning its path"""
+        with self.lock:
+            if self.spillProcessId != os.getpid(): # (first spill, or first in a forked process)
+                self.spillProcessId = os.getpid()
+                self.diskEntries.clear()
+                self.diskUsed = 0
+                self.spillDir = os.path.join(spillFileCache.getProcessDir(), "zip_items")
+                os.makedirs(self.spillDir, exist_ok = True)
+            self.spills += 1
+            fileName = "%s.bin" % self.spills
+        path = os.path.join(self.spillDir, fileName)
+        with open(path, "wb") as outFile:
+            shutil.copyfileobj(itemFile, outFile, 1024*1024)
+            size = outFile.tell()
+        deletedPaths = []
+        with self.lock:
+            oldEntry = self.diskEntries.pop(key, None)
+            if oldEntry != None:
+                self.diskUsed -= oldEntry[1]
+                deletedPaths.append(oldEntry[0])
+            self.diskEntries[key] = (path, size)
+            self.diskUsed += size
+            while self.diskUsed > self.diskBudget and len(self.diskEntries) > 1:
+                oldKey, (oldPath, oldSize) = self.diskEntries.popitem(last = False)
+                self.diskUsed -= oldSize
+                deletedPaths.append(oldPath)
+        for deletedPath in deletedPaths:
+            try:
+                os.remove(deletedPath)
+            except OSError: # still open (on Windows), so leave it to be deleted at exit
+                pass
+        return path
+    
+    def stats(self):
+        with self.lock:
+            return {"memoryEntries": len(self.memoryEntries), "memoryUsed": self.memoryUsed, 
+                    "memoryBudget": self.memoryBudget, 
+                    "diskEntries": len(self.diskEntries), "diskUsed": self.diskUsed, 
+                    "diskBudget": self.diskBudget, 
+                    "hits": self.hits, "misses": self.misses, "spills": self.spills}
+    
+"""Decompressed copies of compressed items needing random access, shared by all ZipItem resources"""
+decompressedItemCache = DecompressedItemCache()
+
+def openRandomAccessFile(fileResource):
+    """Open the contents of a 'file-like' resource as a file which can be read with random access"""
+    if hasattr(fileResource, "path"):
+        return open(fileResource.path, "rb")
+    elif isinstance(fileResource, ZipItem):
+        return fileResource.openRandomAccessFile()
+    else:
+        binaryFile = fileResource.openBinaryFile()
+        if not getattr(binaryFile, "randomAccess", True):
+            with binaryFile:
+                binaryFile = io.BytesIO(binaryFile.read())
+        return binaryFile
     
 class ZipItemsTree:
     """Representation of items in a zip file as a recursively defined tree structure"""
@@ -68,10 +397,27 @@ class ZipFile(Resource):
     
     def checkExists(self):
         self.fileResource.checkExists()
+        
+    def validator(self, view):
+        return self.fileResource.validator(None)
 
     def openZipFile(self):
-        """Return on open (read-only) zipfile.ZipFile object."""
-        return zipfile.ZipFile(self.fileResource.openBinaryFile(), "r")
+        """Return on open (read-only) zipfile.ZipFile object (to be closed after use). 
+        If the contents of the file resource can be identified (see archiveIdentity), as for a 
+        zip file on the local file system or an item in such a zip file (or in a zip file 
+        within that, etc.), the zip file is checked out of zipFilePool."""
+        identity = archiveIdentity(self.fileResource)
+        if identity != None:
+            return zipFilePool.checkout(identity, self.openUnpooledZipFile)
+        else:
+            return self.openUnpooledZipFile()
+        
+    def openUnpooledZipFile(self):
+        if hasattr(self.fileResource, "path"):
+            return zipfile.ZipFile(self.fileResource.path, "r")
+        else:
+            # zipfile seeks around a lot, so it needs random access to the file's contents
+            return ClosingZipFile(openRandomAccessFile(self.fileResource))
     
     @staticmethod
     @interpretationOf(fileLikeResource)
@@ -79,14 +425,18 @@ class ZipFile(Resource):
         return Interpretation(ZipFile(fileResource), "zipFile", 
                               likely = fileResource.extension() in ["zip", "jar", "war"])
     
+    def getZipIndex(self):
+        """Get the ZipIndex for the zip file (cached with the open zip file, if the zip file is pooled)"""
+        with self.openZipFile() as zipFile:
+            if isinstance(zipFile, PooledZipFile):
+                return zipFile.getIndex()
+            else:
+                return ZipIndex(zipFile.infolist())
+    
     def getZipInfos(self):
         """Get the list of ZipInfo objects representing information about the
         items in the zip file."""
-        zipFile = self.openZipFile()
-        try:
-            return zipFile.infolist()
-        finally:
-            zipFile.close()
+        return self.getZipIndex().zipInfos
             
     viewsAndDescriptions = [(View(type), type) for type in ["list", "tree"]]
             
@@ -162,14 +512,13 @@ class ZipFileDir(Resource):
         self.zipFile.checkExists()
         if not (self.isRoot() or self.path.endswith("/")):
             raise NoSuchObjectException("Invalid Zip dir %s does not end with '/'" % self.path)
-        zipFile = self.zipFile.openZipFile()
-        try:
-            zipInfo = zipFile.getinfo(self.path)
-        except KeyError:
-            childItems = self.getChildItems()
-            if len(childItems) == 0:
-                raise NoSuchObjectException("No item or child items for zip dir %s in %s" 
-                                            % (self.path, self.zipFile.heading()))
+        zipIndex = self.zipFile.getZipIndex()
+        if not zipIndex.isDirectory(self.matchPath) or (self.isRoot() and len(zipIndex.names) == 0):
+            raise NoSuchObjectException("No item or child items for zip dir %s in %s" 
+                                        % (self.path, self.zipFile.heading()))
+        
+    def validator(self, view):
+        return self.zipFile.validator(None)
         
     def defaultView(self):
         return View("list")
@@ -187,11 +536,17 @@ class ZipFileDir(Resource):
                 return ZipFileDir(self.zipFile, self.path[0:previousSlashPos+1])
             
     def getZipInfos(self):
-        return [zipInfo for zipInfo in self.zipFile.getZipInfos() if zipInfo.filename.startswith(self.matchPath)]
+        return self.zipFile.getZipIndex().zipInfosWithPrefix(self.matchPath)
         
     def getChildItems(self):
         return [ZipItem(self.zipFile, zipInfo.filename) for zipInfo in self.getZipInfos()]
     
+    def getChildren(self):
+        """Resources for the items and directories (including implied directories) immediately 
+        within this directory, from the ZipIndex's directory map"""
+        return [ZipFileDir(self.zipFile, name) if name.endswith("/") else ZipItem(self.zipFile, name)
+                for name in self.zipFile.getZipIndex().childNames(self.matchPath)]
+    
     @attribute(StringParam("name"))
     def item(self, name):
         """Return a named item from this ZipFileDir as a ZipItem resource"""
@@ -205,11 +560,12 @@ class ZipFileDir(Resource):
 
     @byView("list", showZipItems)
     def showZipItemsAsList(self, view = None):
-        """Show list of links to zip items within the zip file."""
+        """Show list of links to the items and sub-directories immediately within this directory."""
         yield tag.H3("Items")
         yield tag.UL().start()
-        for childItem in self.getChildItems():
-            yield tag.LI(tag.A(h(childItem.name), href = childItem.url()))
+        for child in self.getChildren():
+            name = child.path if isinstance(child, ZipFileDir) else child.name
+            yield tag.LI(tag.A(h(name), href = child.url()))
         yield tag.UL().end()
         
     @byView("tree", showZipItems)
@@ -235,7 +591,113 @@ class ZipFileDir(Resource):
             yield tag.P("Parent: ", tag.A(h(parentPath), href = parentDir.url()))
         for text in self.showZipItems[view.type](self): yield text
 
-import tempfile
+class ZipItemReader(io.RawIOBase):
+    """A read-only binary file giving the contents of an item in a zip file, decompressed as it is
+    read (so memory use doesn't depend on the size of the item). Seeking forward skips data, 
+    seeking backwards starts decompressing again from the beginning. Closing the reader also closes
+    the zip file it was opened from."""
+    
+    randomAccess = False
+    
+    def __init__(self, zipFile, zipInfo):
+        self.zipFile = zipFile
+        self.size = zipInfo.file_size
+        self.member = zipFile.open(zipInfo, "r")
+        
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def read(self, size = -1):
+        return self.member.read(size)
+    
+    def readinto(self, buffer):
+        data = self.member.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+    
+    def seek(self, offset, whence = io.SEEK_SET):
+        return self.member.seek(offset, whence)
+    
+    def tell(self):
+        return self.member.tell()
+    
+    def close(self):
+        if not self.closed:
+            self.member.close()
+            self.zipFile.close()
+        io.RawIOBase.close(self)
+        
+class ZipItemWindow(io.RawIOBase):
+    """A read-only binary file giving the contents of an uncompressed ('stored') item in a zip file, 
+    read directly from the item's data in the zip file, given a random-access file for the zip file 
+    (which may itself be a ZipItemWindow, for zip files stored in zip files). Reading a window 
+    gives true random access. Closing the window also closes the zip file it was opened from.
+    (Unlike ZipItemReader, this does not check the item's CRC.)"""
+    
+    randomAccess = True
+    
+    localFileHeaderFormat = "<4s5H3L2H"
+    
+    def __init__(self, file, zipInfo):
+        self.file = file
+        try:
+            self.start = self.getDataOffset(zipInfo)
+        except:
+            self.file.close()
+            raise
+        self.size = zipInfo.file_size
+        self.position = 0
+        
+    def getDataOffset(self, zipInfo):
+        """Data starts after the local file header, whose file name and 'extra' field lengths
+        may differ from those in the central directory."""
+        headerSize = struct.calcsize(ZipItemWindow.localFileHeaderFormat)
+        self.file.seek(zipInfo.header_offset)
+        header = struct.unpack(ZipItemWindow.localFileHeaderFormat, self.file.read(headerSize))
+        if header[0] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile("Bad local file header for %r" % zipInfo.filename)
+        fileNameLength, extraLength = header[-2:]
+        return zipInfo.header_offset + headerSize + fileNameLength + extraLength
+        
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def readinto(self, buffer):
+        count = min(len(buffer), self.size - self.position)
+        if count <= 0:
+            return 0
+        self.file.seek(self.start + self.position)
+        count = self.file.readinto(memoryview(buffer)[:count])
+        self.position += count
+        return count
+    
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            newPosition = offset
+        elif whence == io.SEEK_CUR:
+            newPosition = self.position + offset
+        elif whence == io.SEEK_END:
+            newPosition = self.size + offset
+        else:
+            raise ValueError("Invalid whence (%r)" % whence)
+        if newPosition < 0:
+            raise ValueError("Negative seek position %r" % newPosition)
+        self.position = newPosition
+        return self.position
+    
+    def tell(self):
+        return self.position
+    
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        io.RawIOBase.close(self)
         
 @resourceTypeNameInModule("item", aptrowModule)
 class ZipItem(Resource):
@@ -257,7 +719,10 @@ class ZipItem(Resource):
         return "Item %s in %s" % (self.name, self.zipFile.heading())
     
     def getZipInfo(self):
-        return self.zipFile.openZipFile().getinfo(self.name)
+        zipInfo = self.zipFile.getZipIndex().getZipInfo(self.name)
+        if zipInfo == None:
+            raise KeyError("There is no item named %r in the archive" % self.name)
+        return zipInfo
     
     def extension(self):
         lastDotPos = self.name.rfind(".")
@@ -268,26 +733,60 @@ class ZipItem(Resource):
         
     def checkExists(self):
         self.zipFile.checkExists()
-        zipFile = self.zipFile.openZipFile()
-        try:
-            zipInfo = zipFile.getinfo(self.name)
-        except KeyError:
+        if self.zipFile.getZipIndex().getZipInfo(self.name) == None:
             raise NoSuchObjectException("Zip item %r not found in %s" % (self.name, self.zipFile.heading()))
 
+    def identity(self):
+        """Identity of the current contents of this item (see archiveIdentity)"""
+        zipFileIdentity = archiveIdentity(self.zipFile.fileResource)
+        if zipFileIdentity == None:
+            return None
+        zipInfo = self.getZipInfo()
+        return ("item", zipFileIdentity, self.name, zipInfo.CRC, zipInfo.file_size)
+    
+    def validator(self, view):
+        """Validator from the item's CRC and size (and the identity of the zip file containing it)"""
+        identity = self.identity()
+        if identity == None:
+            return None
+        return Validator(identity, identityLastModified(identity))
+    
+    def isStored(self, zipInfo):
+        """Is the item stored uncompressed (and unencrypted), so that it can be read in place?"""
+        isEncrypted = zipInfo.flag_bits & 0x1
+        return zipInfo.compress_type == zipfile.ZIP_STORED and not isEncrypted
+    
     def openBinaryFile(self):
-        """Return an open file giving direct access to the contents of the zip item.
-        io.BytesIO is currently used as an intermediary, because the 'file-like' features
-        of the object returned by ZipFile.open are somewhat limited.
+        """Return an open file giving access to the contents of the zip item, read as it is needed:
+        a ZipItemWindow for an uncompressed item, a copy from decompressedItemCache if there is 
+        one already, otherwise a ZipItemReader.
         """
+        zipInfo = self.getZipInfo()
+        if self.isStored(zipInfo):
+            return ZipItemWindow(openRandomAccessFile(self.zipFile.fileResource), zipInfo)
+        identity = self.identity()
+        if identity != None:
+            cachedFile = decompressedItemCache.get(identity)
+            if cachedFile != None:
+                return cachedFile
         zipFile = self.zipFile.openZipFile()
-        memoryFile = io.BytesIO()
-        zipItem = zipFile.open(self.name, "r")
-        zipItemBytes = zipItem.read()
-        memoryFile.write(zipItemBytes)
-        memoryFile.seek(0)
-        zipItem.close()
-        zipFile.close()
-        return memoryFile
+        try:
+            return ZipItemReader(zipFile, zipInfo)
+        except:
+            zipFile.close()
+            raise
+        
+    def openRandomAccessFile(self):
+        """Return an open file giving random access to the contents of the zip item: a ZipItemWindow 
+        for an uncompressed item, otherwise a decompressed copy from decompressedItemCache."""
+        zipInfo = self.getZipInfo()
+        if self.isStored(zipInfo):
+            return ZipItemWindow(openRandomAccessFile(self.zipFile.fileResource), zipInfo)
+        identity = self.identity()
+        if identity == None:
+            with self.openBinaryFile() as binaryFile:
+                return io.BytesIO(binaryFile.read())
+        return decompressedItemCache.open(identity, zipInfo.file_size, self.openBinaryFile)
     
     def getFileName(self):
         nameDir, nameFilePart = os.path.split(self.name)